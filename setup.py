@@ -35,10 +35,12 @@ setup(
     package_data={'barbarians': []},
     package_dir={"": "src/tools"},
     packages=find_namespace_packages(where="src/tools"),
-    python_requires=">=3.6",
+    python_requires=">=3.7",
     entry_points={
         'console_scripts': [
-            'barbarian_rosina=barbarians.rosina.cli:main'
+            'barbarian_rosina=barbarians.rosina.cli:main',
+            'barbarian_rosina_bench=barbarians.rosina.bench:main',
+            'barbarian_rosina_startup=barbarians.rosina.startup:main'
         ]
     }
 )
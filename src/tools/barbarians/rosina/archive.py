@@ -0,0 +1,168 @@
+# Copyright 2022 René Ferdinand Rivera Morell
+# Distributed under the Boost Software License, Version 1.0.
+# (See accompanying file LICENSE.txt or http://www.boost.org/LICENSE_1_0.txt)
+
+import datetime
+import mmap
+import os
+import struct
+import zlib
+
+
+class TrackArchive(object):
+    """
+    Append only archive of track log entries, in compressed files of a day
+    each. A file is a sequence of frames, each of a header followed by the
+    zlib compressed body. The body has a table of the distinct strings in the
+    frame, followed by fixed size records that refer to the strings by index.
+    Entries are tuples of the track log fields: `id`, `package_name`,
+    `package_version`, `package_username`, `package_channel`, `revision`,
+    `dp`, `ua`, `uip`, and `t`.
+    """
+
+    magic = b'RTA1'
+    # Frame header: magic, compressed body size, and number of records.
+    header = struct.Struct("<4sII")
+    # Length of a string in the string table.
+    string_length = struct.Struct("<H")
+    # Record: id, string indices of the eight string fields, and time in
+    # microseconds since the epoch. Index zero is for `None`.
+    record = struct.Struct("<q8Iq")
+    epoch = datetime.datetime(1970, 1, 1)
+    microsecond = datetime.timedelta(microseconds=1)
+
+    def __init__(self, directory, frame_size=10000):
+        self.directory = directory
+        self.frame_size = frame_size
+        self._checked = set()
+
+    def path(self, day):
+        return os.path.join(self.directory, "tracks-{}.rta".format(day.isoformat()))
+
+    def days(self, first=None, last=None):
+        """
+        The days, in order, there are archive files for. Optionally limited
+        to those from first to last.
+        """
+        result = []
+        if not os.path.isdir(self.directory):
+            return result
+        for name in os.listdir(self.directory):
+            if name.startswith("tracks-") and name.endswith(".rta"):
+                day = datetime.datetime.strptime(name[7:-4], "%Y-%m-%d").date()
+                if (not first or day >= first) and (not last or day <= last):
+                    result.append(day)
+        return sorted(result)
+
+    def write(self, entries):
+        """
+        Append the entries to the files of the days of their time. Returns the
+        number of entries written.
+        """
+        count = 0
+        days = {}
+        for entry in entries:
+            days.setdefault(entry[9].date(), []).append(entry)
+            count += 1
+        os.makedirs(self.directory, exist_ok=True)
+        for day, day_entries in sorted(days.items()):
+            path = self.path(day)
+            if path not in self._checked:
+                self.repair(path)
+                self._checked.add(path)
+            with open(path, "ab") as f:
+                for i in range(0, len(day_entries), self.frame_size):
+                    f.write(self.encode(day_entries[i:i+self.frame_size]))
+                f.flush()
+                os.fsync(f.fileno())
+        return count
+
+    def encode(self, entries):
+        """
+        The frame of the entries.
+        """
+        strings = {None: 0}
+        records = []
+        for entry in entries:
+            indices = []
+            for s in entry[1:9]:
+                i = strings.get(s)
+                if i is None:
+                    i = strings[s] = len(strings)
+                indices.append(i)
+            records.append(self.record.pack(
+                entry[0], *indices, (entry[9] - self.epoch) // self.microsecond))
+        body = [struct.pack("<I", len(strings) - 1)]
+        for s in list(strings)[1:]:
+            s = s.encode('utf-8')
+            body.append(self.string_length.pack(len(s)))
+            body.append(s)
+        body = zlib.compress(b''.join(body + records), 6)
+        return self.header.pack(self.magic, len(body), len(records)) + body
+
+    def frames(self, data):
+        """
+        Generate the `(offset, size, count)` of the complete frames in the
+        data. Stopping at the first incomplete, or invalid, frame.
+        """
+        offset = 0
+        while offset + self.header.size <= len(data):
+            magic, size, count = self.header.unpack_from(data, offset)
+            if magic != self.magic or offset + self.header.size + size > len(data):
+                return
+            yield offset + self.header.size, size, count
+            offset += self.header.size + size
+
+    def repair(self, path):
+        """
+        Truncate a partially written frame, from an interrupted write, at the
+        end of the file. So that appended frames can be read.
+        """
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return
+        with open(path, "r+b") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                end = 0
+                for offset, size, count in self.frames(data):
+                    end = offset + size
+                length = len(data)
+            if end < length:
+                f.truncate(end)
+
+    def read(self, first=None, last=None):
+        """
+        Generate the archived entries, of the days from first to last, in
+        order of day and then id. Entries written more than once, by an
+        interrupted archiving that got repeated, are only generated once.
+        """
+        for day in self.days(first, last):
+            with open(self.path(day), "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    last_id = None
+                    for offset, size, count in self.frames(data):
+                        for entry in self.decode(data[offset:offset+size], count):
+                            # The ids in a file only ever increase.
+                            if last_id is not None and entry[0] <= last_id:
+                                continue
+                            last_id = entry[0]
+                            yield entry
+
+    def decode(self, frame, count):
+        body = zlib.decompress(frame)
+        string_count, = struct.unpack_from("<I", body)
+        strings = [None]
+        offset = 4
+        for i in range(string_count):
+            length, = self.string_length.unpack_from(body, offset)
+            offset += self.string_length.size
+            strings.append(body[offset:offset+length].decode('utf-8'))
+            offset += length
+        epoch = self.epoch
+        microsecond = self.microsecond
+        for id, a, b, c, d, e, f, g, h, t in self.record.iter_unpack(
+                memoryview(body)[offset:offset + count * self.record.size]):
+            yield (id, strings[a], strings[b], strings[c], strings[d],
+                   strings[e], strings[f], strings[g], strings[h],
+                   epoch + t * microsecond)
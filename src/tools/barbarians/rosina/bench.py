@@ -0,0 +1,179 @@
+# Copyright 2022 René Ferdinand Rivera Morell
+# Distributed under the Boost Software License, Version 1.0.
+# (See accompanying file LICENSE.txt or http://www.boost.org/LICENSE_1_0.txt)
+
+from argparse import ArgumentParser
+import contextlib
+import datetime
+import itertools
+import json
+import os
+import random
+import resource
+import tempfile
+import time
+from .db import Database, Track
+from .cli import Rosina
+
+
+class Bench(object):
+    """
+    Benchmark of the Rosina tracklog processing. It generates a synthetic track
+    log, with a Zipf distribution of downloads over packages and versions, in a
+    local SQLite database and measures processing it.
+    """
+
+    def __init__(self, argv=None):
+        ap = ArgumentParser(
+            "barbarian_rosina_bench",
+            description="Benchmark tracklog processing on a synthetic track log. Other arguments are passed on to the tracklog command.")
+        ap.add_argument(
+            "--database",
+            help="SQLite database file to use, default is in memory.",
+            default="")
+        ap.add_argument(
+            "--tracks",
+            help="Number of track entries to generate.",
+            type=int,
+            default=100000)
+        ap.add_argument(
+            "--packages",
+            help="Number of packages to generate downloads for.",
+            type=int,
+            default=500)
+        ap.add_argument(
+            "--versions",
+            help="Number of versions of each package.",
+            type=int,
+            default=10)
+        ap.add_argument(
+            "--zipf",
+            help="Exponent of the Zipf distribution of downloads.",
+            type=float,
+            default=1.1)
+        ap.add_argument(
+            "--days",
+            help="Number of days the downloads are spread over.",
+            type=int,
+            default=3)
+        ap.add_argument(
+            "--seed",
+            help="Random seed, for reproducible track logs.",
+            type=int,
+            default=0)
+        ap.add_argument(
+            "--json",
+            help="File to write the results to as JSON.")
+        # Other arguments are passed on to the tracklog command.
+        self.args, self.tracklog_args = ap.parse_known_args(argv)
+        self.phases = {}
+
+        os.environ["DB_KIND"] = "sqlite"
+        os.environ["DB_DATABASE"] = self.args.database
+        self.db = Database()
+        self.db.connect()
+        try:
+            self.run()
+        finally:
+            self.db.close()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        yield
+        self.phases[name] = time.perf_counter() - start
+
+    def run(self):
+        with self.phase("create"), open(os.devnull, "w") as out:
+            with contextlib.redirect_stdout(out):
+                Rosina(["create"], db=self.db)
+        with self.phase("generate"):
+            self.generate_tracks()
+        queries = self.db.query_count
+        with tempfile.TemporaryDirectory() as dir:
+            metrics_json = os.path.join(dir, "metrics.json")
+            with self.phase("tracklog"), open(os.devnull, "w") as out:
+                with contextlib.redirect_stdout(out):
+                    Rosina(["--pdm-stub", "tracklog", "--skip-pdm-cache",
+                            "--quiet", "--metrics-json", metrics_json] +
+                           self.tracklog_args, db=self.db)
+            with open(metrics_json) as f:
+                metrics = json.load(f)
+        tracks = metrics['counters']['tracks']
+        results = {
+            'tracks': tracks,
+            'packages': self.args.packages,
+            'versions': self.args.versions,
+            'zipf': self.args.zipf,
+            'rows_per_second': tracks / self.phases["tracklog"],
+            'queries': self.db.query_count - queries,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'phases': self.phases,
+            'tracklog': metrics,
+        }
+        print("Tracklog of {} entries: {:.0f} rows/sec, {} queries, {:.1f} MB peak memory.".format(
+            results['tracks'], results['rows_per_second'], results['queries'],
+            results['peak_rss_mb']))
+        for name, seconds in self.phases.items():
+            print("  {}: {:.3f} seconds".format(name, seconds))
+        for name, phase in sorted(metrics['phases'].items()):
+            print("    {}: {:.3f} seconds, {:.3f} CPU seconds, {} queries".format(
+                name, phase['wall_seconds'], phase['cpu_seconds'], phase['queries']))
+        if self.args.json:
+            with open(self.args.json, "w") as f:
+                json.dump(results, f, indent=2)
+
+    def zipf_weights(self, n):
+        """
+        The cumulative Zipf distribution weights of n items.
+        """
+        return list(itertools.accumulate(
+            1.0 / (k ** self.args.zipf) for k in range(1, n+1)))
+
+    def generate_tracks(self):
+        r = random.Random(self.args.seed)
+        packages = ["package{}".format(i) for i in range(self.args.packages)]
+        # The most downloaded versions are the newest.
+        versions = ["1.{}.0".format(self.args.versions - i)
+                    for i in range(self.args.versions)]
+        revisions = [None] + ["{:032x}".format(r.getrandbits(128))
+                              for i in range(3)]
+        agents = [
+            "Conan/1.51.0 (Python 3.10.4) python-requests/2.28.1",
+            "Conan/1.59.0 (Python 3.10.6) python-requests/2.28.2",
+            "Conan/2.0.5 (Linux; Python 3.10.6; x86_64) python-requests/2.31.0",
+            "Conan/2.0.5 (Windows; Python 3.11.2; AMD64) python-requests/2.31.0"]
+        package_weights = self.zipf_weights(len(packages))
+        version_weights = self.zipf_weights(len(versions))
+        end = datetime.datetime.now().replace(microsecond=0)
+        seconds = self.args.days * 24 * 60 * 60
+        rows = []
+        with self.db.atomic():
+            for i in range(self.args.tracks):
+                name = r.choices(packages, cum_weights=package_weights)[0]
+                version = r.choices(versions, cum_weights=version_weights)[0]
+                rows.append({
+                    'package_name': name,
+                    'package_version': version,
+                    'package_username': None,
+                    'package_channel': None,
+                    'revision': r.choice(revisions),
+                    'dp': "/github/v1/files/_/{}/{}/_/export/conan_export.tgz".format(
+                        name, version),
+                    'ua': r.choice(agents),
+                    'uip': "10.{}.{}.{}".format(
+                        r.randrange(256), r.randrange(256), r.randrange(256)),
+                    't': end - datetime.timedelta(seconds=r.randrange(seconds))})
+                if len(rows) >= 100:
+                    Track.insert_many(rows).execute()
+                    rows = []
+            if rows:
+                Track.insert_many(rows).execute()
+
+
+def main():
+    Bench()
+
+
+if __name__ == '__main__':
+    main()
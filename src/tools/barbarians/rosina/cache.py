@@ -0,0 +1,82 @@
+# Copyright 2022 René Ferdinand Rivera Morell
+# Distributed under the Boost Software License, Version 1.0.
+# (See accompanying file LICENSE.txt or http://www.boost.org/LICENSE_1_0.txt)
+
+import json
+import os
+import sqlite3
+import time
+
+
+def default_cache_dir():
+    return os.path.join(
+        os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+        "barbarian")
+
+
+class PackageInfoCache(object):
+    """
+    Persistent cache of the PDM information of packages, stored in an SQLite
+    file. Entries are keyed by the full package reference, including the
+    revision, expire after a time to live, and the least recently used ones
+    are evicted when there are more than the maximum entries.
+    """
+
+    def __init__(self, path, ttl=7*24*60*60, max_entries=10000):
+        dir = os.path.dirname(path)
+        if dir:
+            os.makedirs(dir, exist_ok=True)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS package_info ('
+                ' key TEXT PRIMARY KEY, info TEXT,'
+                ' created REAL, accessed REAL)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS package_info_accessed'
+                ' ON package_info (accessed)')
+
+    @staticmethod
+    def key(name, version, identity):
+        return "{}/{}@{}".format(name, version, identity)
+
+    def get(self, key):
+        """
+        The cached info for the key, or None if there is no live entry.
+        """
+        now = time.time()
+        with self.connection:
+            row = self.connection.execute(
+                'SELECT info FROM package_info WHERE key = ? AND created > ?',
+                (key, now - self.ttl)).fetchone()
+            if row:
+                self.connection.execute(
+                    'UPDATE package_info SET accessed = ? WHERE key = ?',
+                    (now, key))
+        if row:
+            self.hits += 1
+            return json.loads(row[0])
+        self.misses += 1
+        return None
+
+    def put(self, key, info):
+        now = time.time()
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO package_info VALUES (?, ?, ?, ?)',
+                (key, json.dumps(info), now, now))
+            self.connection.execute(
+                'DELETE FROM package_info WHERE created <= ?',
+                (now - self.ttl,))
+            self.connection.execute(
+                'DELETE FROM package_info WHERE key IN ('
+                ' SELECT key FROM package_info'
+                ' ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,))
+
+    def close(self):
+        self.connection.close()
@@ -2,15 +2,27 @@
 # Distributed under the Boost Software License, Version 1.0.
 # (See accompanying file LICENSE.txt or http://www.boost.org/LICENSE_1_0.txt)
 
-from argparse import ArgumentParser
-import conans.client.conan_api
+from argparse import ArgumentParser, Namespace
 import datetime
+import json
+import os
 import peewee
-import playhouse
-import playhouse.migrate
-import semver
+import signal
+import threading
+import time
 import uuid
+import zlib
 from .db import Database, Track, Project, Package, Stat, Models, Meta, Model
+from .db import BatchWriter, StatWriter, LatestPackage, Client, version_key
+from .db import Sketch, SketchWriter, Popularity, PopularityWriter
+from . import pdm
+from .cache import PackageInfoCache, default_cache_dir
+from .metrics import Metrics, timed_call
+from .archive import TrackArchive
+from .client import parse_client
+from .hll import HyperLogLog
+from .index import SearchIndex, project_terms
+from .export import SnapshotExport
 
 
 class Rosina(object):
@@ -21,18 +33,29 @@ class Rosina(object):
 
     pdm_conan = "conan"
 
-    def __init__(self):
+    def __init__(self, argv=None, db=None):
         ap = ArgumentParser(
             "barbarian_rosina",
             description='''\
 Required environment variables for database connection: DB_HOST, DB_USER,
-DB_PASSWORD, DB_DATABASE.
+DB_PASSWORD, DB_DATABASE. Optionally DB_KIND, one of: mysql, mariadb, or
+sqlite (with DB_DATABASE as the file, or empty for in memory).
 ''')
         ap.add_argument(
             "--mariadb",
             help="Use MariaDB backend instead of MySQL.",
             action="store_true",
             default=False)
+        ap.add_argument(
+            "--pdm-stub",
+            help="Use synthetic package info instead of fetching it from the PDM.",
+            action="store_true",
+            default=False)
+        ap.add_argument(
+            "--pdm-client",
+            help="How to fetch the Conan package info: with the Conan client, or directly from the REST API of the remote.",
+            choices=["conan", "rest"],
+            default="conan")
 
         ap_sub = ap.add_subparsers(dest="command")
 
@@ -50,19 +73,321 @@ DB_PASSWORD, DB_DATABASE.
             help="Skip deleting processed tracklog entries.",
             action="store_true",
             default=False)
+        ap_tracklog.add_argument(
+            "--stat-span",
+            help="Time span of the download statistics buckets.",
+            choices=self.stat_spans,
+            default="hour")
+        ap_tracklog.add_argument(
+            "--batch-size",
+            help="Number of rows to write to the database at a time.",
+            type=int,
+            default=500)
+        ap_tracklog.add_argument(
+            "--chunk-size",
+            help="Number of track entries to process, and commit, at a time.",
+            type=int,
+            default=10000)
+        ap_tracklog.add_argument(
+            "--shards",
+            help="Number of processes to process the track entries with, each a partition of the package names.",
+            type=int,
+            default=1)
+        ap_tracklog.add_argument(
+            "--max-rows",
+            help="Maximum number of track entries to process in this run.",
+            type=int,
+            default=0)
+        ap_tracklog.add_argument(
+            "--max-seconds",
+            help="Maximum seconds to spend processing track entries in this run.",
+            type=float,
+            default=0)
+        ap_tracklog.add_argument(
+            "--quiet",
+            help="Skip printing information for each package and project.",
+            action="store_true",
+            default=False)
+        ap_tracklog.add_argument(
+            "--metrics-json",
+            help="File to write the processing metrics to as JSON.")
+        ap_tracklog.add_argument(
+            "--metrics-prom",
+            help="File to write the processing metrics to in the Prometheus text format.")
+        ap_tracklog.add_argument(
+            "--stream",
+            help="Stream the track entries from the database on a separate connection.",
+            action="store_true",
+            default=False)
+        ap_tracklog.add_argument(
+            "--refresh-workers",
+            help="Number of processes to fetch the project data from PDM info with.",
+            type=int,
+            default=1)
+        ap_tracklog.add_argument(
+            "--refresh-timeout",
+            help="Seconds to wait for the PDM info of each project, when using refresh workers.",
+            type=float,
+            default=120.0)
+        ap_tracklog.add_argument(
+            "--pdm-cache",
+            help="File to cache the PDM info of package revisions in.",
+            default=os.path.join(default_cache_dir(), "rosina-pdm.sqlite"))
+        ap_tracklog.add_argument(
+            "--pdm-cache-ttl",
+            help="Hours to keep PDM info in the cache.",
+            type=float,
+            default=7*24)
+        ap_tracklog.add_argument(
+            "--pdm-cache-size",
+            help="Maximum number of packages to keep PDM info in the cache for.",
+            type=int,
+            default=10000)
+        ap_tracklog.add_argument(
+            "--skip-client-stats",
+            help="Skip the download statistics broken down by client.",
+            action="store_true",
+            default=False)
+        ap_tracklog.add_argument(
+            "--skip-uniques",
+            help="Skip the sketches of unique downloaders.",
+            action="store_true",
+            default=False)
+        ap_tracklog.add_argument(
+            "--skip-pdm-cache",
+            help="Skip using, and updating, the cache of PDM info.",
+            action="store_true",
+            default=False)
+        ap_tracklog.add_argument(
+            "--delete-batch-size",
+            help="Number of processed track entries to delete at a time.",
+            type=int,
+            default=5000)
+        ap_tracklog.add_argument(
+            "--delete-pause",
+            help="Seconds to pause between deleting batches of processed track entries.",
+            type=float,
+            default=0.1)
+        ap_tracklog.add_argument(
+            "--archive",
+            help="Directory to archive processed track entries to, before deleting them.")
+        ap_tracklog.add_argument(
+            "--export",
+            help="Directory to export the catalog snapshot files to, after processing.")
+        ap_tracklog.add_argument(
+            "--watch",
+            help="Keep processing new track entries as they arrive, until interrupted.",
+            action="store_true",
+            default=False)
+        ap_tracklog.add_argument(
+            "--poll-min",
+            help="Minimum seconds to wait between checks for new track entries, when watching.",
+            type=float,
+            default=5.0)
+        ap_tracklog.add_argument(
+            "--poll-max",
+            help="Maximum seconds to wait between checks for new track entries, when watching.",
+            type=float,
+            default=300.0)
+
+        # "compact" command..
+        ap_compact = ap_sub.add_parser(
+            "compact",
+            help="Roll up old statistics into coarser time spans.")
+        ap_compact.add_argument(
+            "--daily-after",
+            help="Days after which statistics are rolled up into daily spans.",
+            type=int,
+            default=7)
+        ap_compact.add_argument(
+            "--monthly-after",
+            help="Days after which statistics are rolled up into monthly spans.",
+            type=int,
+            default=90)
+        ap_compact.add_argument(
+            "--batch-size",
+            help="Number of rows to write to the database at a time.",
+            type=int,
+            default=500)
+        ap_compact.add_argument(
+            "--full",
+            help="Compact all statistics, instead of continuing from the last run.",
+            action="store_true",
+            default=False)
+
+        # "archive" command..
+        ap_archive = ap_sub.add_parser(
+            "archive",
+            help="Archive processed track entries to files, or replay archived entries to statistics.")
+        ap_archive.add_argument(
+            "directory",
+            help="Directory of the archive files.")
+        ap_archive.add_argument(
+            "--replay",
+            help="Add the statistics of the archived entries to the database, instead of archiving.",
+            action="store_true",
+            default=False)
+        ap_archive.add_argument(
+            "--from",
+            help="First day, as YYYY-MM-DD, of the archived entries to replay.",
+            dest="first",
+            type=lambda s: datetime.datetime.strptime(s, "%Y-%m-%d").date())
+        ap_archive.add_argument(
+            "--to",
+            help="Last day, as YYYY-MM-DD, of the archived entries to replay.",
+            dest="last",
+            type=lambda s: datetime.datetime.strptime(s, "%Y-%m-%d").date())
+        ap_archive.add_argument(
+            "--stat-span",
+            help="Time span of the download statistics buckets, when replaying.",
+            choices=self.stat_spans,
+            default="hour")
+        ap_archive.add_argument(
+            "--skip-client-stats",
+            help="Skip the download statistics broken down by client, when replaying.",
+            action="store_true",
+            default=False)
+        ap_archive.add_argument(
+            "--skip-uniques",
+            help="Skip the sketches of unique downloaders, when replaying.",
+            action="store_true",
+            default=False)
+        ap_archive.add_argument(
+            "--batch-size",
+            help="Number of rows to write to the database at a time.",
+            type=int,
+            default=500)
+        ap_archive.add_argument(
+            "--chunk-size",
+            help="Number of track entries to process, and commit, at a time.",
+            type=int,
+            default=10000)
+
+        # "uniques" command..
+        ap_uniques = ap_sub.add_parser(
+            "uniques",
+            help="Estimate the unique downloaders of a package.")
+        ap_uniques.add_argument(
+            "name",
+            help="Name of the package.")
+        ap_uniques.add_argument(
+            "--version",
+            help="Version of the package, instead of all versions.")
+        ap_uniques.add_argument(
+            "--from",
+            help="First day, as YYYY-MM-DD, to count downloaders for.",
+            dest="first",
+            type=lambda s: datetime.datetime.strptime(s, "%Y-%m-%d"))
+        ap_uniques.add_argument(
+            "--to",
+            help="Last day, as YYYY-MM-DD, to count downloaders for.",
+            dest="last",
+            type=lambda s: datetime.datetime.strptime(s, "%Y-%m-%d"))
+
+        # Ingest command..
+        ap_ingest = ap_sub.add_parser(
+            "ingest",
+            help="Add the entries of access log files to the track log.")
+        ap_ingest.add_argument(
+            "files",
+            help="Access log files, of JSON lines of the track fields. Optionally gzip compressed.",
+            nargs="+")
+        ap_ingest.add_argument(
+            "--batch-size",
+            help="Number of track entries to insert at a time.",
+            type=int,
+            default=1000)
+        ap_ingest.add_argument(
+            "--chunk-size",
+            help="Number of track entries to add, and commit, at a time.",
+            type=int,
+            default=10000)
+        ap_ingest.add_argument(
+            "--forget-days",
+            help="Days after which the offsets of files that aren't seen are forgotten.",
+            type=int,
+            default=30)
+
+        # Export command..
+        ap_export = ap_sub.add_parser(
+            "export",
+            help="Export the catalog of projects and packages as snapshot files.")
+        ap_export.add_argument(
+            "directory",
+            help="Directory to write the snapshot files to.")
+        ap_export.add_argument(
+            "--full",
+            help="Export all the projects, instead of the ones changed since the last export.",
+            action="store_true",
+            default=False)
+
+        # "build-index" command..
+        ap_build_index = ap_sub.add_parser(
+            "build-index",
+            help="Build the search index file of the projects.")
+        ap_build_index.add_argument(
+            "output",
+            help="Search index file to write.")
+        ap_build_index.add_argument(
+            "--full",
+            help="Rebuild from all the projects, instead of the ones updated since the last build.",
+            action="store_true",
+            default=False)
+
+        # "search" command..
+        ap_search = ap_sub.add_parser(
+            "search",
+            help="Search for projects in a search index file.")
+        ap_search.add_argument(
+            "index",
+            help="Search index file to search in.")
+        ap_search.add_argument(
+            "words",
+            help="Words to search for, the last one can be partial.",
+            nargs="+")
+        ap_search.add_argument(
+            "--limit",
+            help="Maximum number of projects to show.",
+            type=int,
+            default=20)
 
         # Info command..
         ap_info = ap_sub.add_parser(
             "info",
             help="Show information about the database.")
+        ap_info.add_argument(
+            "--top",
+            help="Number of packages with the most pending downloads to show.",
+            type=int,
+            default=10)
+        ap_info.add_argument(
+            "--sample",
+            help="Number of pending track entries to show.",
+            type=int,
+            default=0)
+        ap_info.add_argument(
+            "--json",
+            help="Output the information as JSON.",
+            action="store_true",
+            default=False)
 
         # Database management commands..
         ap_create = ap_sub.add_parser(
             "create",
             help="Create schema in an empty database.")
+        ap_create.add_argument(
+            "--partition-tracks",
+            help="Partition the track log by day, to drop processed days whole (MySQL only).",
+            action="store_true",
+            default=False)
         ap_migrate = ap_sub.add_parser(
             "migrate",
             help="Migrate the database schema to the latest version.")
+        ap_migrate.add_argument(
+            "--partition-tracks",
+            help="Partition the track log by day, to drop processed days whole (MySQL only).",
+            action="store_true",
+            default=False)
         ap_turnoff = ap_sub.add_parser(
             "turnoff",
             help="Mark the database off, and out of service.")
@@ -70,12 +395,18 @@ DB_PASSWORD, DB_DATABASE.
             "turnon",
             help="Mark the database on, and in service.")
 
-        self.args = ap.parse_args()
+        self._db = db
+        self.verbose = True
+        self.metrics = Metrics("rosina")
+        self.watching = False
+        self.stopping = threading.Event()
+        self.args = ap.parse_args(argv)
         if self.args.command:
-            if hasattr(self, "command_"+self.args.command):
-                getattr(self, "command_"+self.args.command)(self.args)
+            command = "command_"+self.args.command.replace("-", "_")
+            if hasattr(self, command):
+                getattr(self, command)(self.args)
 
-        if self._db:
+        if self._db and not db:
             self._db.close()
 
     # The databass..
@@ -85,21 +416,35 @@ DB_PASSWORD, DB_DATABASE.
     @property
     def db(self):
         if not self._db:
-            self._db = Database()
+            # Long running processes use a pool of connections, which get
+            # checked, and replaced, between uses.
+            self._db = Database(pooled=getattr(self.args, 'watch', False))
             self._db.connect()
         return self._db
 
+    def connect(self):
+        """
+        Connect to the database, and bind the models to it. For commands that
+        only use the models.
+        """
+        return self.db
+
     # Commands..
 
     def command_create(self, args):
         print("Creating models:", *Models)
         self.db.create_tables(Models)
+        if not self.db.is_mysql:
+            # The full text search keys are MySQL specific.
+            return
         self.db.execute_sql(
             'ALTER TABLE `barbarian_project` ADD FULLTEXT KEY `fulltext_all` (`name`,`description_brief`,`topic`);')
         self.db.execute_sql(
             'ALTER TABLE `barbarian_project` ADD FULLTEXT KEY `fulltext_topic` (`topic`);')
         self.db.execute_sql(
             'ALTER TABLE `barbarian_project` ADD FULLTEXT KEY `fulltext_name` (`name`);')
+        if args.partition_tracks:
+            self.partition_tracks()
 
     def command_turnoff(self, args):
         self.do_set_in_service(False)
@@ -109,6 +454,18 @@ DB_PASSWORD, DB_DATABASE.
         self.do_set_in_service(True)
         print("Placed the database in service.")
 
+    def get_meta(self, id, default=None):
+        """
+        The value of the metadata entry, or the default when there isn't one.
+        """
+        with self.db.atomic():
+            meta = Meta.get_or_none(Meta.id == id)
+            return meta.value if meta else default
+
+    def set_meta(self, id, value):
+        with self.db.atomic():
+            Meta.replace(id=id, value=value).execute()
+
     def do_set_in_service(self, in_service=True):
         with self.db.atomic():
             meta, created = Meta.get_or_create(
@@ -119,30 +476,39 @@ DB_PASSWORD, DB_DATABASE.
             return result
 
     def command_migrate(self, args):
+        """
+        Migrate the database schema, one version at a time, to the latest
+        version. The steps of each version migration are resumable.
+        """
         in_service = self.do_set_in_service(False)
         if in_service:
             print("Placed the database out of service for the migration.")
-        with self.db.atomic():
-            version = Meta.get(Meta.id == "version")
-            schema_version_past = int(version.value['schema'])
-            schema_version_future = int(Meta.version['schema'])
-            while schema_version_past < schema_version_future:
-                migrate_f = "do_migrate_{}_to_{}".format(
-                    schema_version_past, schema_version_future)
-                if not hasattr(self, migrate_f):
-                    break
-                print("Migrating from schema version",
-                      schema_version_past, "to", schema_version_future, "...")
-                getattr(self, migrate_f)(args)
-                with self.db.atomic():
-                    version.value['scheme'] = str(schema_version_past+1)
-                    version.save()
-                print("Migration to schema version",
-                      schema_version_future, "complete.")
-                schema_version_past += 1
-            if schema_version_past < schema_version_future:
-                print("WARNING: No schema migration from",
-                      schema_version_past, "to", schema_version_future, "possible.")
+        from .migrate import Migration
+        schema_version_past = int(self.get_meta("version")['schema'])
+        schema_version_future = int(Meta.version['schema'])
+        while schema_version_past < schema_version_future:
+            schema_version_next = schema_version_past + 1
+            migrate_f = "do_migrate_{}_to_{}".format(
+                schema_version_past, schema_version_next)
+            if not hasattr(self, migrate_f):
+                break
+            print("Migrating from schema version",
+                  schema_version_past, "to", schema_version_next, "...")
+            self.migration = Migration(self.db, schema_version_next)
+            self.migration.run(getattr(self, migrate_f)(args))
+            with self.db.atomic():
+                version = self.get_meta("version")
+                version['schema'] = str(schema_version_next)
+                self.set_meta("version", version)
+                self.migration.finish()
+            print("Migration to schema version",
+                  schema_version_next, "complete.")
+            schema_version_past = schema_version_next
+        if schema_version_past < schema_version_future:
+            print("WARNING: No schema migration from",
+                  schema_version_past, "to", schema_version_future, "possible.")
+        if args.partition_tracks:
+            self.partition_tracks()
         if in_service:
             self.do_set_in_service(True)
             print("Place the database back in service.")
@@ -158,188 +524,1665 @@ DB_PASSWORD, DB_DATABASE.
         Migrates a v1 database to v2 by: generating uuid values for projects and
         replacing the v1 IDs with them.
         """
+        import playhouse.migrate
         Rosina.Project_1_to_2.bind(self.db)
         migrator = playhouse.migrate.MySQLMigrator(self.db)
-        # Generate UUIDs for the existing projects.
-        project_id2uuid = {}
-        with self.db.atomic():
-            for project in Rosina.Project_1_to_2.select(Rosina.Project_1_to_2.id):
-                new_uuid = uuid.uuid4()
-                print("Assigning uuid", new_uuid, "to project #", project.id)
-                project_id2uuid[str(project.id)] = new_uuid
-        # Drop the indices, constraints, foreign keys so we can restructure.
-        self.db.execute_sql(
-            'ALTER TABLE barbarian_project DROP PRIMARY KEY;')
-        playhouse.migrate.migrate(
-            migrator.drop_index('barbarian_package', 'unique_package'))
-        # Project.. Rename & retype columns, and refill with new data.
-        # The playhouse migrate fails on mysql renames because the column
-        # descriptions come back as binary instead of text. So we do the rename.
-        self.db.execute_sql(
-            'ALTER TABLE barbarian_project RENAME COLUMN id TO uuid;')
-        playhouse.migrate.migrate(
-            migrator.alter_column_type('barbarian_project', 'uuid', peewee.UUIDField(primary_key=True)))
-        with self.db.atomic():
-            for project_id, project_uuid in project_id2uuid.items():
-                update_sql = "UPDATE barbarian_project SET uuid = '" + \
-                    project_uuid.hex+"' WHERE uuid = '"+project_id+"';"
-                self.db.execute_sql(update_sql)
-        # Packages.. Retype columns, and refill with new data.
-        playhouse.migrate.migrate(
-            migrator.alter_column_type(
-                'barbarian_package', 'project', peewee.UUIDField()))
-        with self.db.atomic():
-            for project_id, project_uuid in project_id2uuid.items():
-                update_sql = "UPDATE barbarian_package SET project = '" + \
-                    project_uuid.hex+"' WHERE project = '"+project_id+"';"
-                self.db.execute_sql(update_sql)
-        # Stats.. Retype columns, and refill with new data.
-        playhouse.migrate.migrate(
-            migrator.alter_column_type(
-                'barbarian_stat', 'project', peewee.UUIDField()))
+
+        def map_projects():
+            # Generate UUIDs for the existing projects.
+            self.migration.create_mapping("project", {
+                project.id: uuid.uuid4().hex
+                for project in Rosina.Project_1_to_2.select(
+                    Rosina.Project_1_to_2.id)})
+
+        def drop_keys():
+            # Drop the indices, constraints, foreign keys so we can
+            # restructure.
+            self.db.execute_sql(
+                'ALTER TABLE barbarian_project DROP PRIMARY KEY;')
+            playhouse.migrate.migrate(
+                migrator.drop_index('barbarian_package', 'unique_package'))
+
+        def project_column():
+            # The playhouse migrate fails on mysql renames because the column
+            # descriptions come back as binary instead of text. So we do the
+            # rename.
+            self.db.execute_sql(
+                'ALTER TABLE barbarian_project RENAME COLUMN id TO uuid;')
+            playhouse.migrate.migrate(
+                migrator.alter_column_type(
+                    'barbarian_project', 'uuid', peewee.UUIDField(primary_key=True)))
+
+        def add_keys():
+            # Recreate the indices, constraints, foreign keys.
+            self.db.execute_sql(
+                'ALTER TABLE barbarian_package ADD PRIMARY KEY (`project`,`name`,`version`,`identity`,`packager`)')
+            self.db.execute_sql(
+                'CREATE INDEX `package_project` ON barbarian_package (`project`)')
+            playhouse.migrate.migrate(
+                migrator.add_foreign_key_constraint(
+                    'barbarian_package', 'project', 'barbarian_project', 'uuid'))
+            self.db.execute_sql(
+                'CREATE INDEX `package_project` ON barbarian_stat (`project`)')
+            playhouse.migrate.migrate(
+                migrator.add_foreign_key_constraint(
+                    'barbarian_stat', 'project', 'barbarian_project', 'uuid'))
+
+        return [
+            ("map_projects", map_projects),
+            ("drop_keys", drop_keys),
+            # Project.. Rename & retype columns, and refill with new data.
+            ("project_column", project_column),
+            ("project_uuids", lambda: self.migration.remap(
+                'barbarian_project', 'uuid', "project")),
+            # Packages.. Retype columns, and refill with new data.
+            ("package_column", lambda: playhouse.migrate.migrate(
+                migrator.alter_column_type(
+                    'barbarian_package', 'project', peewee.UUIDField()))),
+            ("package_projects", lambda: self.migration.remap(
+                'barbarian_package', 'project', "project")),
+            # Stats.. Retype columns, and refill with new data.
+            ("stat_column", lambda: playhouse.migrate.migrate(
+                migrator.alter_column_type(
+                    'barbarian_stat', 'project', peewee.UUIDField()))),
+            ("stat_projects", lambda: self.migration.remap(
+                'barbarian_stat', 'project', "project", key='id')),
+            ("add_keys", add_keys),
+            ("drop_map_projects", lambda: self.migration.drop_mapping("project")),
+        ]
+
+    def command_compact(self, args):
+        """
+        Roll up the statistics older than the horizons into daily, and then
+        monthly, time spans. Each span is compacted in its own transaction,
+        and verified to keep the same totals.
+        """
+        progress = {} if args.full else self.get_meta("compact", {})
+        now = datetime.datetime.now()
+        for span, days in (('day', args.daily_after), ('month', args.monthly_after)):
+            # Only compact whole spans that are past the horizon.
+            horizon = self.stat_span(
+                now - datetime.timedelta(days=days), span)[0]
+            span_start = progress.get(span)
+            if span_start:
+                span_start = datetime.datetime.fromisoformat(span_start)
+            rows_before = 0
+            rows_after = 0
+            sketches_before_total = 0
+            sketches_after_total = 0
+            while True:
+                with self.db.atomic():
+                    # Skip to the next span that has stats.
+                    query = Stat.select(peewee.fn.MIN(Stat.span_start)).where(
+                        Stat.span_start < horizon)
+                    if span_start:
+                        query = query.where(Stat.span_start >= span_start)
+                    first = query.scalar()
+                    if not first:
+                        break
+                    span_start, span_end = self.stat_span(
+                        Stat.span_start.python_value(first), span)
+                    before, after = self.compact_stats(
+                        span_start, span_end, args.batch_size)
+                    sketches_before, sketches_after = self.compact_sketches(
+                        span_start, span_end, args.batch_size)
+                    progress[span] = span_end.isoformat()
+                    self.set_meta("compact", progress)
+                rows_before += before
+                rows_after += after
+                sketches_before_total += sketches_before
+                sketches_after_total += sketches_after
+                span_start = span_end
+            print("[INFO] Compacted {} stats into {} {} stats.".format(
+                rows_before, rows_after, span))
+            print("[INFO] Merged {} sketches into {} {} sketches.".format(
+                sketches_before_total, sketches_after_total, span))
+
+    def compact_stats(self, span_start, span_end, batch_size):
+        """
+        Compact the stats within the time span into stats of the whole span.
+        Returns the number of stats before and after.
+        """
+        in_span = [Stat.span_start >= span_start, Stat.span_end <= span_end]
+        total_before = Stat.select(
+            peewee.fn.SUM(Stat.value_i)).where(*in_span).scalar() or 0
+        # Collect the stats for each package and stat kind.
+        key_fields = [getattr(Stat, f) for f in StatWriter.key_fields[0:6]]
+        groups = {}
+        for row in Stat.select(
+                Stat.id, *key_fields, Stat.client, Stat.span_start,
+                Stat.span_end, Stat.value_i).where(*in_span).tuples().iterator():
+            groups.setdefault(row[1:8], []).append(row)
+        # Replace the stats that are not already the span kind with the sum of
+        # them. The old stats get deleted before writing, as they may include
+        # a stat of the span kind the writer would otherwise add to.
+        values = {}
+        ids = []
+        for key, rows in groups.items():
+            if len(rows) == 1 and rows[0][8:10] == (span_start, span_end):
+                continue
+            for row in rows:
+                ids.append(row[0])
+                values[key] = values.get(key, 0) + row[10]
+        for i in range(0, len(ids), batch_size):
+            Stat.delete().where(Stat.id.in_(ids[i:i+batch_size])).execute()
+        writer = StatWriter(batch_size)
+        for key, value in values.items():
+            writer.add(*key[0:6], span_start, span_end, value, key[6])
+        writer.flush()
+        # Check that we didn't lose anything.
+        total_after = Stat.select(
+            peewee.fn.SUM(Stat.value_i)).where(*in_span).scalar() or 0
+        if total_after != total_before:
+            raise RuntimeError(
+                "Compacting stats from {} to {} changed the total from {} to {}.".format(
+                    span_start, span_end, total_before, total_after))
+        return len(ids), writer.written
+
+    def compact_sketches(self, span_start, span_end, batch_size):
+        """
+        Merge the sketches within the time span into sketches of the whole
+        span. Returns the number of sketches before and after.
+        """
+        key_fields = [getattr(Sketch, f) for f in SketchWriter.key_fields[0:5]]
+        groups = {}
+        for row in Sketch.select(
+                Sketch.id, *key_fields, Sketch.span_start, Sketch.span_end,
+                Sketch.sketch).where(
+                    Sketch.span_start >= span_start,
+                    Sketch.span_end <= span_end).tuples().iterator():
+            groups.setdefault(row[1:6], []).append(row)
+        sketches = {}
+        ids = []
+        for key, rows in groups.items():
+            if len(rows) == 1 and rows[0][6:8] == (span_start, span_end):
+                continue
+            for row in rows:
+                ids.append(row[0])
+                sketch = HyperLogLog.from_bytes(row[8])
+                if key in sketches:
+                    sketches[key].merge(sketch)
+                else:
+                    sketches[key] = sketch
+        for i in range(0, len(ids), batch_size):
+            Sketch.delete().where(Sketch.id.in_(ids[i:i+batch_size])).execute()
+        writer = SketchWriter(batch_size)
+        for key, sketch in sketches.items():
+            writer.add(*key, span_start, span_end, sketch)
+        writer.flush()
+        return len(ids), writer.written
+
+    def command_uniques(self, args):
+        """
+        Estimate the unique downloaders of a package, or a version of it, by
+        merging its sketches for the days. Sketches rolled up into months
+        count entirely when they overlap the days.
+        """
+        self.connect()
+        query = Sketch.select(Sketch.sketch).where(
+            Sketch.package_name == args.name)
+        if args.version:
+            query = query.where(Sketch.package_version == args.version)
+        if args.first:
+            query = query.where(Sketch.span_end > args.first)
+        if args.last:
+            query = query.where(
+                Sketch.span_start < args.last + datetime.timedelta(days=1))
+        sketch = HyperLogLog()
+        count = 0
+        for row in query.tuples().iterator():
+            sketch.merge(HyperLogLog.from_bytes(row[0]))
+            count += 1
+        print("[INFO] Unique downloaders of {}{}: {} (from {} sketches).".format(
+            args.name, " " + args.version if args.version else "",
+            sketch.count(), count))
+
+    def do_migrate_2_to_3(self, args):
+        """
+        Migrates a v2 database to v3 by: adding the latest package table and
+        filling it in from the existing packages.
+        """
+        return [
+            ("latest_package_table", lambda: self.db.create_tables(
+                [LatestPackage], safe=True)),
+            ("fill_latest_packages", self.fill_latest_packages),
+        ]
+
+    def fill_latest_packages(self):
+        """
+        Replace the latest packages with those found from all the packages.
+        """
+        latest = {}
         with self.db.atomic():
-            for project_id, project_uuid in project_id2uuid.items():
-                update_sql = "UPDATE barbarian_stat SET project = '" + \
-                    project_uuid.hex+"' WHERE project = '"+project_id+"';"
-                self.db.execute_sql(update_sql)
-        # Recreate the indices, constraints, foreign keys.
-        self.db.execute_sql(
-            'ALTER TABLE barbarian_package ADD PRIMARY KEY (`project`,`name`,`version`,`identity`,`packager`)')
-        self.db.execute_sql(
-            'CREATE INDEX `package_project` ON barbarian_package (`project`)')
-        playhouse.migrate.migrate(
-            migrator.add_foreign_key_constraint(
-                'barbarian_package', 'project', 'barbarian_project', 'uuid'))
-        self.db.execute_sql(
-            'CREATE INDEX `package_project` ON barbarian_stat (`project`)')
-        playhouse.migrate.migrate(
-            migrator.add_foreign_key_constraint(
-                'barbarian_stat', 'project', 'barbarian_project', 'uuid'))
+            for package in Package.select().iterator():
+                key = version_key(package.version)
+                if not key:
+                    continue
+                project_packager = (package.project_id, package.packager)
+                if key > latest.get(project_packager, {}).get('version_key', ""):
+                    latest[project_packager] = {
+                        'project': package.project_id,
+                        'packager': package.packager,
+                        'name': package.name,
+                        'version': package.version,
+                        'identity': package.identity,
+                        'version_key': key}
+            print("Adding latest packages for", len(latest), "projects.")
+            writer = BatchWriter(LatestPackage, replace=True)
+            for row in latest.values():
+                writer.add(row)
+            writer.flush()
+
+    def do_migrate_3_to_4(self, args):
+        """
+        Migrates a v3 database to v4 by: adding the client table, and the
+        client of stats.
+        """
+        import playhouse.migrate
+        migrator = playhouse.migrate.SchemaMigrator.from_database(self.db.obj)
+        return [
+            ("client_table", lambda: self.db.create_tables([Client], safe=True)),
+            ("stat_client_column", lambda: playhouse.migrate.migrate(
+                migrator.add_column(
+                    Stat._meta.table_name, 'client', Stat.client))),
+        ]
+
+    def do_migrate_4_to_5(self, args):
+        """
+        Migrates a v4 database to v5 by: adding the sketches table.
+        """
+        return [
+            ("sketch_table", lambda: self.db.create_tables([Sketch], safe=True)),
+        ]
+
+    def do_migrate_5_to_6(self, args):
+        """
+        Migrates a v5 database to v6 by: adding the popularity table and
+        filling it in from the existing download stats.
+        """
+        def fill_popularity():
+            with self.db.atomic():
+                writer = PopularityWriter(self.popularity_epoch())
+                for project, span_start, downloads in Stat.select(
+                        Stat.project, Stat.span_start, peewee.fn.SUM(Stat.value_i)
+                ).where(Stat.stat == 'down').group_by(
+                        Stat.project, Stat.span_start).tuples().iterator():
+                    writer.add(project, Stat.span_start.python_value(span_start),
+                               int(downloads))
+                writer.flush()
+                print("Added popularity for", writer.written, "projects.")
+
+        return [
+            ("popularity_table", lambda: self.db.create_tables(
+                [Popularity], safe=True)),
+            ("fill_popularity", fill_popularity),
+        ]
+
+    class Stat_6_to_7(Stat):
+        class Meta:
+            table_name = 'barbarian_migrate_stat'
+
+    def do_migrate_6_to_7(self, args):
+        """
+        Migrates a v6 database to v7 by: merging the stats of the same key,
+        into a new stat table with the unique index of the stat keys, and
+        replacing the stat table with it.
+        """
+        Rosina.Stat_6_to_7.bind(self.db)
+        stat_table = Stat._meta.table_name
+        merged_table = Rosina.Stat_6_to_7._meta.table_name
+        old_table = "barbarian_migrate_stat_old"
+        key_columns = [getattr(Stat, f) for f in StatWriter.key_fields]
+
+        def merge_stats():
+            with self.db.atomic():
+                self.db.drop_tables([Rosina.Stat_6_to_7], safe=True)
+                self.db.create_tables([Rosina.Stat_6_to_7])
+                Rosina.Stat_6_to_7.insert_from(
+                    Stat.select(*key_columns, peewee.fn.SUM(Stat.value_i)).group_by(
+                        *key_columns),
+                    StatWriter.key_fields + ['value_i']).execute()
+
+        def replace_stats():
+            if self.db.is_mysql:
+                self.db.execute_sql(
+                    "RENAME TABLE `{s}` TO `{o}`, `{m}` TO `{s}`".format(
+                        s=stat_table, o=old_table, m=merged_table))
+            else:
+                with self.db.atomic():
+                    self.db.execute_sql("ALTER TABLE `{}` RENAME TO `{}`".format(
+                        stat_table, old_table))
+                    self.db.execute_sql("ALTER TABLE `{}` RENAME TO `{}`".format(
+                        merged_table, stat_table))
+
+        return [
+            ("merge_stats", merge_stats),
+            ("replace_stats", replace_stats),
+            ("drop_old_stats", lambda: self.db.execute_sql(
+                "DROP TABLE IF EXISTS `{}`".format(old_table))),
+        ]
+
+    def do_migrate_7_to_8(self, args):
+        """
+        Migrates a v7 database to v8 by: merging the sketches of the same key,
+        and adding the unique index of the sketch keys.
+        """
+        import playhouse.migrate
+        migrator = playhouse.migrate.SchemaMigrator.from_database(self.db.obj)
+        key_columns = [getattr(Sketch, f) for f in SketchWriter.key_fields]
+
+        def merge_sketches():
+            # The sketches of the keys that have more than one, which get
+            # merged into the first of them.
+            duplicates = Sketch.select(*key_columns).group_by(
+                *key_columns).having(peewee.fn.COUNT(Sketch.id) > 1).alias(
+                    'duplicates')
+            on = None
+            for c in key_columns:
+                duplicate = getattr(duplicates.c, c.column_name)
+                match = c == duplicate
+                if c.null:
+                    match = match | (c.is_null() & duplicate.is_null())
+                on = match if on is None else on & match
+            sketches = {}
+            with self.db.atomic():
+                for row in Sketch.select(
+                        Sketch.id, Sketch.sketch, *key_columns).join(
+                            duplicates, on=on).order_by(
+                                Sketch.id).tuples().iterator():
+                    key = Sketch.collation_key(row[2:])
+                    if key in sketches:
+                        sketches[key][1].append(row[0])
+                        sketches[key][2].merge(HyperLogLog.from_bytes(row[1]))
+                    else:
+                        sketches[key] = (
+                            row[0], [], HyperLogLog.from_bytes(row[1]))
+                ids = []
+                for sketch_id, merged_ids, sketch in sketches.values():
+                    Sketch.update(sketch=sketch.to_bytes()).where(
+                        Sketch.id == sketch_id).execute()
+                    ids.extend(merged_ids)
+                for i in range(0, len(ids), 500):
+                    Sketch.delete().where(
+                        Sketch.id.in_(ids[i:i+500])).execute()
+            print("Merged", len(ids), "duplicate sketches.")
+
+        return [
+            ("merge_sketches", merge_sketches),
+            ("sketch_key_index", lambda: playhouse.migrate.migrate(
+                migrator.add_index(
+                    Sketch._meta.table_name, Sketch._meta.indexes[0][0],
+                    unique=True))),
+        ]
+
+    def do_migrate_8_to_9(self, args):
+        """
+        Migrates a v8 database to v9 by: filling in the latest packages again,
+        with the version_key that orders prereleases correctly.
+        """
+        return [
+            ("fill_latest_packages", self.fill_latest_packages),
+        ]
+
+    def command_ingest(self, args):
+        """
+        Add the entries of the access log files to the track log. The offset
+        of each file, up to which the entries got added, is recorded in the
+        "ingest" Meta entry in the same transaction as the entries. Such that
+        files are continued where they were left, also after they get
+        rotated, without duplicate entries.
+        """
+        from .ingest import AccessLog, track_entry
+        start = time.perf_counter()
+        now = datetime.datetime.now()
+        state = self.get_meta("ingest", {})
+        added = 0
+        invalid = 0
+
+        def write(rows, key, path, offset):
+            with self.db.atomic():
+                for i in range(0, len(rows), args.batch_size):
+                    Track.insert_many(rows[i:i+args.batch_size]).execute()
+                state[key] = {
+                    'path': path, 'offset': offset,
+                    'seen': now.strftime("%Y-%m-%dT%H:%M:%S")}
+                self.set_meta("ingest", state)
+
+        for path in args.files:
+            log = AccessLog(path)
+            key = log.fingerprint()
+            if not key:
+                continue
+            offset = state.get(key, {}).get('offset', 0)
+            rows = []
+            for end, line in log.lines(offset):
+                try:
+                    rows.append(track_entry(line))
+                except ValueError as error:
+                    print("[ERROR] Ignoring invalid entry in {} at {}: {}".format(
+                        path, offset, error))
+                    invalid += 1
+                offset = end
+                if len(rows) >= args.chunk_size:
+                    write(rows, key, path, offset)
+                    added += len(rows)
+                    rows = []
+            write(rows, key, path, offset)
+            added += len(rows)
+        # Forget the files that are long gone.
+        horizon = (now - datetime.timedelta(days=args.forget_days)).strftime(
+            "%Y-%m-%dT%H:%M:%S")
+        forget = [key for key, file in state.items() if file['seen'] < horizon]
+        if forget:
+            for key in forget:
+                del state[key]
+            self.set_meta("ingest", state)
+        print("[INFO] Added {} track entries, ignored {} invalid ones, in {:.1f} seconds.".format(
+            added, invalid, time.perf_counter() - start))
+
+    def command_export(self, args):
+        self.connect()
+        self.export_snapshots(args.directory, args.full)
+
+    def export_snapshots(self, directory, full=False):
+        """
+        Export the catalog to snapshot files: one per project, with its
+        packages, and one of the whole catalog. Only the projects updated,
+        added, or with new packages, since the last export are read. The
+        rest of the files are kept as they are.
+        """
+        start = time.perf_counter()
+        now = datetime.datetime.now()
+        export = SnapshotExport(directory)
+        exported = None
+        if not full and export.manifest['exported']:
+            exported = datetime.datetime.strptime(
+                export.manifest['exported'], "%Y-%m-%dT%H:%M:%S.%f")
+        # Packages only get added. Hence their count tells which projects
+        # have new ones.
+        counts = dict(Package.select(
+            Package.project, peewee.fn.COUNT(Package.project)).group_by(
+                Package.project).tuples())
+        package_counts = {
+            u: counts.get(u, 0) for u, in Project.select(Project.uuid).tuples()}
+        files = {"projects/{}.json.gz".format(u): u for u in package_counts}
+        for name in list(export.manifest['files']):
+            if name.startswith("projects/") and name not in files:
+                export.remove(name)
+        if exported:
+            changed = set(u for u, in Project.select(Project.uuid).where(
+                Project.updated >= exported).tuples())
+            for name, project_uuid in files.items():
+                entry = export.manifest['files'].get(name)
+                if not entry or entry['packages'] != package_counts[project_uuid]:
+                    changed.add(project_uuid)
+        else:
+            changed = set(package_counts)
+        changed = list(changed)
+        for i in range(0, len(changed), 500):
+            packages = {}
+            for package in Package.select().where(
+                    Package.project.in_(changed[i:i+500])).order_by(
+                        Package.name, Package.version, Package.identity):
+                packages.setdefault(package.project_id, []).append({
+                    'name': package.name, 'version': package.version,
+                    'identity': package.identity, 'packager': package.packager})
+            for project in Project.select().where(
+                    Project.uuid.in_(changed[i:i+500])):
+                document = self.project_snapshot(project)
+                document['packages'] = packages.get(project.uuid, [])
+                export.write(
+                    "projects/{}.json.gz".format(project.uuid), document,
+                    packages=len(document['packages']))
+        # The catalog only has the brief data of the projects.
+        if export.changed or export.removed or not export.etag("catalog.json.gz"):
+            export.write("catalog.json.gz", {'products': [{
+                'uuid': str(project_uuid),
+                'name': name,
+                'description_brief': description or "",
+                'topic': topic or [],
+                'license': license or "",
+            } for project_uuid, name, description, topic, license in Project.select(
+                Project.uuid, Project.name, Project.description_brief,
+                Project.topic, Project.license).order_by(Project.name).tuples()]})
+        export.finish(now.strftime("%Y-%m-%dT%H:%M:%S.%f"))
+        if self.verbose:
+            print("[INFO] Exported {} of {} snapshot files, {} removed, in {:.1f} seconds.".format(
+                len(export.changed), len(export.manifest['files']),
+                len(export.removed), time.perf_counter() - start))
+
+    def project_snapshot(self, project):
+        """
+        The snapshot of the full project data, as the corum product API has it.
+        """
+        result = {
+            'uuid': str(project.uuid),
+            'name': project.name,
+            'description_brief': project.description_brief or "",
+            'topic': project.topic or [],
+            'license': project.license or "",
+            'updated': project.updated.isoformat() if project.updated else None,
+        }
+        info = dict(project.info or {})
+        for key in ('homepage', 'author'):
+            if info.get(key):
+                result[key] = info[key]
+        description = info.get('barbarian', {}).get('description')
+        if description:
+            result['description_full'] = {
+                'text': description.get('text'),
+                'format': description.get('format')}
+            for key in ('barbarian', 'name', 'topics', 'license', 'description'):
+                info.pop(key, None)
+            result['info'] = info
+        return result
+
+    def command_build_index(self, args):
+        """
+        Build the search index file of the projects. The terms of the projects
+        are kept in a documents file next to the index. Such that only the
+        projects updated, or added, since the last build need to be read.
+        """
+        start = time.perf_counter()
+        now = datetime.datetime.now()
+        documents_path = args.output + ".docs"
+        built = None
+        documents = {}
+        if not args.full and os.path.exists(documents_path):
+            with open(documents_path, "rb") as f:
+                state = json.loads(zlib.decompress(f.read()))
+            built = datetime.datetime.strptime(
+                state['built'], "%Y-%m-%dT%H:%M:%S.%f")
+            documents = state['projects']
+        epoch = self.get_meta("popularity", {}).get('epoch')
+        # The projects to read are the new and updated ones, and those deleted
+        # are dropped.
+        uuids = set(str(u) for u, in Project.select(Project.uuid).tuples())
+        documents = {u: d for u, d in documents.items() if u in uuids}
+        fields = [Project.uuid, Project.name, Project.description_brief,
+                  Project.topic, Project.license]
+        if built:
+            queries = [Project.select(*fields).where(Project.updated >= built)]
+            added = list(uuids - set(documents))
+            for i in range(0, len(added), 500):
+                queries.append(Project.select(*fields).where(
+                    Project.uuid.in_(added[i:i+500])))
+        else:
+            queries = [Project.select(*fields)]
+        read = 0
+        for query in queries:
+            for project_uuid, name, description, topic, license in query.tuples().iterator():
+                documents[str(project_uuid)] = [
+                    name, license, project_terms(name, description, topic)]
+                read += 1
+        # The popularity weights change all the time, hence are always read.
+        decay = 1.0
+        if epoch:
+            decay = Popularity.weights(datetime.datetime.strptime(
+                epoch, "%Y-%m-%dT%H:%M:%S"), now)['trend_month']
+        popularity = {
+            str(u): trend * decay for u, trend in Popularity.select(
+                Popularity.project, Popularity.trend_month).tuples()}
+        SearchIndex.write(args.output, {
+            u: (name, license, popularity.get(u, 0.0), terms)
+            for u, (name, license, terms) in documents.items()})
+        with open(documents_path + ".tmp", "wb") as f:
+            f.write(zlib.compress(json.dumps({
+                'built': now.strftime("%Y-%m-%dT%H:%M:%S.%f"),
+                'projects': documents}).encode('utf-8')))
+        os.replace(documents_path + ".tmp", documents_path)
+        print("[INFO] Indexed {} projects, {} read, in {:.1f} seconds.".format(
+            len(documents), read, time.perf_counter() - start))
+
+    def command_search(self, args):
+        index = SearchIndex(args.index)
+        try:
+            for result in index.search(" ".join(args.words), args.limit):
+                print("{name} ({license}) #{uuid}: {score:.2f}".format(**result))
+        finally:
+            index.close()
 
     def command_info(self, args):
-        with self.db.atomic():
-            # For stability we limit the set of tracking entries to those older
-            # than a specific datetime, now.
-            now = datetime.datetime.now()
-            # Query all the track log data, and process one at a time.
-            for track_i in Track.select().where(Track.t < now).iterator():
-                print("> ", track_i.package_name, track_i.package_version,
-                      track_i.package_username, track_i.package_channel)
+        """
+        Show the state of the database: schema version, service status, the
+        backlog of track entries waiting for tracklog, and the sizes of the
+        tables. All from aggregate queries.
+        """
+        info = {
+            'schema': self.get_meta("version", {}).get('schema'),
+            'in_service': self.get_meta("status", {}).get('in_service'),
+        }
+        # The pending track entries are those after the tracklog watermark.
+        watermark = self.get_meta("tracklog", {}).get('watermark', 0)
+        pending = Track.select().where(Track.id > watermark)
+        count, oldest, newest = Track.select(
+            peewee.fn.COUNT(Track.id), peewee.fn.MIN(Track.t),
+            peewee.fn.MAX(Track.t)).where(Track.id > watermark).tuples()[0]
+        info['backlog'] = {
+            'watermark': watermark,
+            'entries': count,
+            'oldest': Track.t.python_value(oldest),
+            'newest': Track.t.python_value(newest),
+        }
+        downloads = peewee.fn.COUNT(Track.id).alias('downloads')
+        info['backlog']['top'] = [
+            {'name': name, 'version': version, 'downloads': downloads}
+            for name, version, downloads in pending.select(
+                Track.package_name, Track.package_version, downloads
+            ).group_by(Track.package_name, Track.package_version).order_by(
+                downloads.desc()).limit(args.top).tuples()]
+        if args.sample:
+            info['backlog']['sample'] = [
+                dict(zip((f.name for f in self.archive_fields), track))
+                for track in pending.select(*self.archive_fields).order_by(
+                    Track.id).limit(args.sample).tuples()]
+        info['tables'] = self.table_sizes()
+        if args.json:
+            print(json.dumps(info, indent=2, default=str))
+            return
+        print("Schema version:", info['schema'])
+        print("In service:", info['in_service'])
+        print("Track backlog: {} entries after #{}, from {} to {}.".format(
+            count, watermark, info['backlog']['oldest'], info['backlog']['newest']))
+        for package in info['backlog']['top']:
+            print("  {name} {version}: {downloads} downloads".format(**package))
+        for track in info['backlog'].get('sample', []):
+            print(">", *track.values())
+        print("Tables:")
+        for name, table in sorted(info['tables'].items()):
+            print("  {}: {} rows{}".format(
+                name, table['rows'],
+                ", {:.1f} MB".format(table['bytes'] / 1024 / 1024)
+                if table['bytes'] is not None else ""))
+
+    def table_sizes(self):
+        """
+        The number of rows, and bytes, of the tables. For MySQL these are the
+        estimates from the information schema, and otherwise the exact
+        counts without the sizes.
+        """
+        result = {}
+        if self.db.is_mysql:
+            cursor = self.db.execute_sql(
+                "SELECT `TABLE_NAME`, `TABLE_ROWS`, `DATA_LENGTH` + `INDEX_LENGTH` "
+                "FROM `information_schema`.`TABLES` "
+                "WHERE `TABLE_SCHEMA` = DATABASE() AND `TABLE_NAME` LIKE 'barbarian\\_%%'")
+            for name, rows, size in cursor.fetchall():
+                result[name] = {'rows': rows, 'bytes': size}
+        else:
+            for model in Models:
+                result[model._meta.table_name] = {
+                    'rows': model.select().count(), 'bytes': None}
+        return result
 
     def command_tracklog(self, args):
         """
         Process track log entries to add and update the database of projects
-        and packages.
+        and packages. Once, or continuously when watching.
         """
-        with self.db.atomic():
-            # For stability we limit the set of tracking entries to those older
-            # than a specific datetime, now.
-            now = datetime.datetime.now()
-            # The projects that get updated and refreshed.
-            projects = {}
-            # Query all the track log data, and process one at a time.
-            track_i = Track.select().where(Track.t < now).order_by(
-                Track.package_name, Track.package_version,
-                Track.package_username, Track.package_channel
-            ).iterator()
-            track_e = next(track_i, None)
-            while track_e is not None:
-                print("[INFO] Tracking for package: {}".format(
-                    (track_e.package_name, track_e.package_version,
-                        track_e.package_username, track_e.package_channel)))
-                # Find or create project for package.
-                current_project = self.obtain_project(
-                    track_e.package_name, self.pdm_conan)
-                if current_project.uuid in projects:
-                    current_project = projects[current_project.uuid]
+        if args.watch:
+            self.watch_tracklog(args)
+        else:
+            self.tracklog_once(args)
+
+    def watch_tracklog(self, args):
+        """
+        Process the track log repeatedly, until stopped by a signal. Waiting
+        between runs according to the backlog of track entries: none when
+        there's more than a chunk, the minimum when there's some, and
+        increasingly longer, up to the maximum, when there's none. The
+        database connection pool, indexes, and PDM workers are kept between
+        runs.
+        """
+        def stop(signum, frame):
+            print("[INFO] Stopping tracklog on signal {}.".format(signum))
+            self.stopping.set()
+        handlers = {s: signal.signal(s, stop)
+                    for s in (signal.SIGINT, signal.SIGTERM)}
+        self.watching = True
+        interval = 0
+        try:
+            while not self.stopping.is_set():
+                self.db.connect(reuse_if_open=True)
+                try:
+                    pending = self.tracklog_once(args)
+                except peewee.OperationalError as error:
+                    # Lost the database, try again later with a new
+                    # connection.
+                    print("[ERROR] Failed processing tracklog:", error)
+                    pending = 0
+                    # The index may have entries that didn't get committed.
+                    self._package_index = None
+                    self._client_index = None
+                finally:
+                    # Return the connection to the pool while waiting.
+                    self.db.close()
+                if pending >= args.chunk_size:
+                    interval = 0
+                elif pending > 0:
+                    interval = args.poll_min
                 else:
-                    projects[current_project.uuid] = current_project
-                # Find or create package that matches current track entry.
-                current_package = self.obtain_package(
-                    current_project,
-                    track_e.package_name,
-                    track_e.package_version,
-                    track_e.package_identity,
-                    self.pdm_conan)
-                # Track the stats for this package. Or move on to the next one.
-                while track_e is not None:
-                    if track_e.package_name != current_package.name or \
-                            track_e.package_version != current_package.version or \
-                        track_e.package_identity != current_package.identity or \
-                            self.pdm_conan != current_package.packager:
-                        break
-                    else:
-                        stat = Stat.create(
-                            project=current_project,
-                            package_name=track_e.package_name,
-                            package_version=track_e.package_version,
-                            package_identity=track_e.package_identity,
-                            packager=self.pdm_conan,
-                            span_start=track_e.t, span_end=track_e.t,
-                            stat='down', value_i=1)
-                        stat.save()
-                        track_e = next(track_i, None)
-            # Refresh the data for the projects we encountered.
-            if not args.skip_project_refresh:
-                for project in projects.values():
-                    self.refresh_project(project)
-            # Clear out processed tracklog entries.
-            if not args.skip_delete:
-                Track.delete().where(Track.t < now).execute()
+                    interval = min(
+                        max(interval * 2, args.poll_min), args.poll_max)
+                if self.verbose or interval == args.poll_max:
+                    print("[INFO] Tracklog backlog of {} entries, waiting {:.1f} seconds.".format(
+                        pending, interval))
+                self.stopping.wait(interval)
+        finally:
+            self.watching = False
+            self.close_worker_pool()
+            self.close_rest_client()
+            for s, handler in handlers.items():
+                signal.signal(s, handler)
+
+    def tracklog_once(self, args):
+        """
+        Process the track log entries present now, or as many as the budget
+        allows. Returns the number of entries still waiting to be processed.
+        """
+        start = time.perf_counter()
+        track_count = 0
+        self.verbose = not args.quiet
+        self.metrics = Metrics("rosina_tracklog", self.db)
+        self.create_writers(args.batch_size)
+        # Continue from where the last run left off, including refreshing the
+        # projects it didn't get to.
+        with self.metrics.phase("select_tracks"):
+            checkpoint = self.get_meta("tracklog", {})
+            watermark = checkpoint.get('watermark', 0)
+            projects = set(uuid.UUID(u) for u in checkpoint.get('refresh', []))
+            # For stability we limit the set of tracking entries to those
+            # present now, i.e. up to the current last entry.
+            last_id = Track.select(peewee.fn.MAX(Track.id)).scalar() or 0
+        # Process the track log in chunks, one transaction each, until done or
+        # out of budget. Sharded, when asked to or when continuing a sharded
+        # run, and otherwise in order.
+        deadline = start + args.max_seconds if args.max_seconds else None
+        shards = checkpoint.get('shards')
+        if not shards and args.shards > 1 and last_id > watermark:
+            shards = {'count': args.shards, 'last': last_id}
+            self.set_meta("tracklog", dict(checkpoint, shards=shards))
+        complete = True
+        if shards:
+            with self.metrics.phase("shards"):
+                complete, shard_count, shard_projects = self.tracklog_shards(
+                    args, watermark, shards['count'], shards['last'], deadline)
+            track_count += shard_count
+            projects |= shard_projects
+            if complete:
+                watermark = shards['last']
+            last_id = watermark
+        tracks = self.read_tracks(watermark, last_id, args)
+        chunks = self.metrics.timed("select_tracks", self.chunk_tracks(
+            tracks, args.chunk_size, deadline))
+        for chunk in chunks:
+            if self.stopping.is_set():
+                break
+            with self.metrics.phase("count_tracks"):
+                counts = self.count_tracks(
+                    chunk, args.stat_span, not args.skip_client_stats)
+            sketches = {}
+            if not args.skip_uniques:
+                with self.metrics.phase("sketch_tracks"):
+                    sketches = self.sketch_tracks(chunk)
+            with self.db.atomic():
+                projects |= self.write_track_counts(counts, sketches)
+                # Record the progress along with the chunk results.
+                with self.metrics.phase("write_stats"):
+                    watermark = chunk[-1][0]
+                    self.set_meta("tracklog", {
+                        'watermark': watermark,
+                        'refresh': sorted(str(u) for u in projects)})
+            track_count += len(chunk)
+        tracks.close()
+        self.metrics.count("tracks", track_count)
+        self.metrics.count("projects_touched", len(projects))
+        if not complete:
+            print("[INFO] Sharded tracklog incomplete, it continues in the next run.")
+        # Refresh the data for the projects we encountered.
+        if complete and not args.skip_project_refresh:
+            cache = None
+            if not args.skip_pdm_cache:
+                cache = PackageInfoCache(
+                    args.pdm_cache, args.pdm_cache_ttl*60*60, args.pdm_cache_size)
+            try:
+                with self.metrics.phase("refresh"):
+                    self.refresh_projects(
+                        projects, args.refresh_workers, args.refresh_timeout, cache)
+            finally:
+                if cache:
+                    if self.verbose or projects:
+                        print("[INFO] PDM info cache hits: {}, misses: {}.".format(
+                            cache.hits, cache.misses))
+                    self.metrics.count("pdm_cache_hits", cache.hits)
+                    self.metrics.count("pdm_cache_misses", cache.misses)
+                    cache.close()
+            self.set_meta("tracklog", {'watermark': watermark, 'refresh': []})
+        if args.export:
+            with self.metrics.phase("export"):
+                self.export_snapshots(args.export)
+        # Keep the raw processed entries, when archiving. Only the archived
+        # ones can then be deleted.
+        purge_watermark = watermark
+        if complete and args.archive:
+            with self.metrics.phase("archive"):
+                archived, purge_watermark = self.archive_tracks(
+                    TrackArchive(args.archive, args.chunk_size), watermark,
+                    args.chunk_size)
+            self.metrics.count("tracks_archived", archived)
+            purge_watermark = min(watermark, purge_watermark)
+        # Clear out processed tracklog entries. Except for the last one, so
+        # that the ids of new entries don't start over below the watermark
+        # when the table is empty. It gets deleted in a later run.
+        if complete and not args.skip_delete:
+            with self.metrics.phase("delete"):
+                deleted = self.purge_tracks(
+                    purge_watermark, args.delete_batch_size, args.delete_pause)
+            self.metrics.count("tracks_deleted", deleted)
+        seconds = time.perf_counter() - start
+        # The summary is for runs that did something, or when asked for. As
+        # watching polls quietly most of the time.
+        report = self.verbose or track_count > 0
+        if report:
+            print("[INFO] Processed {} track entries in {:.1f} seconds ({:.0f} rows/sec).".format(
+                track_count, seconds, track_count / seconds if seconds > 0 else 0))
+            for writer in (self.project_writer, self.package_writer, self.stat_writer):
+                print("[INFO] Wrote {} {} rows in {:.1f} seconds ({:.0f} rows/sec).".format(
+                    writer.written, writer.model.__name__, writer.seconds,
+                    writer.written / writer.seconds if writer.seconds > 0 else 0))
+        for writer in (self.project_writer, self.package_writer,
+                       self.stat_writer, self.latest_writer, self.sketch_writer,
+                       self.popularity_writer):
+            name = peewee.make_snake_case(writer.model.__name__)
+            self.metrics.count(name + "_rows_written", writer.written)
+            self.metrics.count(name + "_write_seconds", writer.seconds)
+        if report:
+            for name, phase in sorted(self.metrics.phases.items()):
+                print("[INFO] Phase {}: {:.3f} seconds, {:.3f} CPU seconds, {} queries.".format(
+                    name, phase['wall_seconds'], phase['cpu_seconds'], phase['queries']))
+        if args.metrics_json:
+            self.metrics.write_json(args.metrics_json)
+        if args.metrics_prom:
+            self.metrics.write_prometheus(args.metrics_prom)
+        last_id = Track.select(peewee.fn.MAX(Track.id)).scalar() or watermark
+        return max(0, last_id - watermark)
+
+    def create_writers(self, batch_size):
+        """
+        New rows get written in batches. Projects first, as packages and stats
+        refer to them.
+        """
+        self.project_writer = BatchWriter(Project, batch_size)
+        self.package_writer = BatchWriter(
+            Package, batch_size, [self.project_writer], ignore=True)
+        self.stat_writer = StatWriter(
+            batch_size, [self.project_writer, self.package_writer])
+        self.latest_writer = BatchWriter(
+            LatestPackage, batch_size, [self.project_writer], replace=True)
+        self.sketch_writer = SketchWriter(batch_size, [self.project_writer])
+        self.popularity_writer = PopularityWriter(
+            self.popularity_epoch(), batch_size, [self.project_writer])
+
+    # Days after which the popularity epoch moves forward, to keep the
+    # forward decayed scores from growing too large.
+    popularity_epoch_days = 180
+
+    def popularity_epoch(self):
+        """
+        The epoch of the forward decayed popularity scores. When it gets old
+        it moves to today, and the existing scores get scaled down to match.
+        """
+        today = datetime.datetime.combine(
+            datetime.date.today(), datetime.time())
+        with self.db.atomic():
+            epoch = self.get_meta("popularity", {}).get('epoch')
+            epoch = datetime.datetime.strptime(
+                epoch, "%Y-%m-%dT%H:%M:%S") if epoch else None
+            if epoch and (today - epoch).days <= self.popularity_epoch_days:
+                return epoch
+            if epoch:
+                scales = Popularity.weights(epoch, today)
+                Popularity.update({
+                    getattr(Popularity, field): getattr(Popularity, field) * scale
+                    for field, scale in scales.items()}).execute()
+            self.set_meta("popularity", {'epoch': today.isoformat()})
+        return today
+
+    def command_archive(self, args):
+        """
+        Archive the track entries processed by tracklog. Or replay archived
+        entries through the tracklog aggregation, to add their statistics to
+        the database. Which can be a local SQLite database, to recompute
+        statistics without the production database.
+        """
+        start = time.perf_counter()
+        archive = TrackArchive(args.directory, args.chunk_size)
+        if args.replay:
+            self.verbose = False
+            self.create_writers(args.batch_size)
+            track_count = 0
+            entries = ((e[0], e[1], e[2], e[3], e[4], e[5], e[9], e[7], e[8])
+                       for e in archive.read(args.first, args.last))
+            for chunk in self.chunk_tracks(entries, args.chunk_size):
+                counts = self.count_tracks(
+                    chunk, args.stat_span, not args.skip_client_stats)
+                sketches = {}
+                if not args.skip_uniques:
+                    sketches = self.sketch_tracks(chunk)
+                with self.db.atomic():
+                    self.write_track_counts(counts, sketches)
+                track_count += len(chunk)
+            print("[INFO] Replayed {} archived track entries in {:.1f} seconds.".format(
+                track_count, time.perf_counter() - start))
+        else:
+            watermark = self.get_meta("tracklog", {}).get('watermark', 0)
+            archived, watermark = self.archive_tracks(
+                archive, watermark, args.chunk_size)
+            print("[INFO] Archived {} track entries, up to #{}, in {:.1f} seconds.".format(
+                archived, watermark, time.perf_counter() - start))
+
+    # All the track entry fields, in the order of the archived entries.
+    archive_fields = [
+        Track.id, Track.package_name, Track.package_version,
+        Track.package_username, Track.package_channel, Track.revision,
+        Track.dp, Track.ua, Track.uip, Track.t]
+
+    def archive_tracks(self, archive, up_to, chunk_size):
+        """
+        Append the track entries, from the last archived one up to the given
+        one, to the archive. The progress is recorded after each chunk. An
+        interruption can have some entries archived twice, which the archive
+        reader skips. Returns the number of entries archived, and the id of
+        the last archived entry.
+        """
+        watermark = self.get_meta("archive", {}).get('watermark', 0)
+        count = 0
+        while watermark < up_to:
+            entries = list(Track.select(*self.archive_fields).where(
+                Track.id > watermark, Track.id <= up_to
+            ).order_by(Track.id).limit(chunk_size).tuples())
+            if not entries:
+                watermark = up_to
+                break
+            count += archive.write(entries)
+            watermark = entries[-1][0]
+            self.set_meta("archive", {'watermark': watermark})
+        return count, watermark
+
+    # The track entry fields used to compute stats, in the order of the tuples
+    # that are processed.
+    track_fields = [
+        Track.id, Track.package_name, Track.package_version,
+        Track.package_username, Track.package_channel, Track.revision, Track.t,
+        Track.ua, Track.uip]
+
+    def read_tracks(self, watermark, last_id, args, shard=None):
+        """
+        Generate the track entries after the watermark, up to the last one, in
+        order. Each entry is a tuple of the `track_fields`. Optionally only
+        those of a shard, given as `(shard, shards)`.
+        """
+        where = [Track.id > watermark, Track.id <= last_id]
+        if shard:
+            where.append(self.track_shard(shard[1]) == shard[0])
+        query = Track.select(*self.track_fields).where(
+            *where).order_by(Track.id)
+        if args.max_rows:
+            query = query.limit(args.max_rows)
+        if args.stream:
+            for track in self.db.stream(query, self.track_fields, args.batch_size):
+                yield track
+        else:
+            # Read in chunks, to avoid the client side buffering of the whole
+            # result.
+            count = 0
+            while not args.max_rows or count < args.max_rows:
+                limit = args.chunk_size
+                if args.max_rows:
+                    limit = min(limit, args.max_rows - count)
+                tracks = list(Track.select(*self.track_fields).where(
+                    *where).order_by(Track.id).limit(limit).tuples())
+                if not tracks:
+                    break
+                for track in tracks:
+                    yield track
+                count += len(tracks)
+                where[0] = Track.id > tracks[-1][0]
+
+    def track_shard(self, shards):
+        """
+        The expression of the shard of a track entry, from the CRC32 of its
+        package name. Such that all the entries of a package, and project, are
+        in the same shard. SQLite doesn't have the functions, hence they get
+        added to it.
+        """
+        if not self.db.is_mysql:
+            self.db.obj.register_function(
+                lambda s: zlib.crc32(s.encode('utf-8')) if s is not None else None,
+                "CRC32", 1)
+            self.db.obj.register_function(
+                lambda a, b: a % b if a is not None else None, "MOD", 2)
+        return peewee.fn.MOD(peewee.fn.CRC32(Track.package_name), shards)
+
+    def tracklog_shards(self, args, watermark, shards, last_id, deadline):
+        """
+        Process the track entries after the watermark, up to the last one, in
+        shards. Each shard in a process of its own, with its own connection
+        and transactions, and progress in its own checkpoint. Once all the
+        shards complete the tracklog checkpoint moves to the last entry.
+        Returns if it completed, the number of track entries processed, and
+        the projects to refresh.
+        """
+        import multiprocessing
+        # Clients are shared among shards, hence added up front. And the
+        # package index gets shared by loading it before starting the shards.
+        if not args.skip_client_stats:
+            for ua, in Track.select(Track.ua).distinct().where(
+                    Track.id > watermark, Track.id <= last_id).tuples():
+                self.obtain_client(*parse_client(ua))
+        self.load_package_index()
+        print("[INFO] Processing track entries up to {} in {} shards.".format(
+            last_id, shards))
+        # The shard processes make their own connections.
+        self.db.close()
+        context = multiprocessing.get_context("fork")
+        processes = [context.Process(
+            target=self.tracklog_shard,
+            args=(args, shard, shards, watermark, last_id, deadline))
+            for shard in range(shards)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        # The shards added projects, packages, and latest packages, that the
+        # indexes here don't have. Hence they get loaded again when needed.
+        self._project_index = None
+        self._package_index = None
+        self._latest_index = None
+        self._client_index = None
+        self.db.connect(reuse_if_open=True)
+        checkpoints = [self.get_meta("tracklog-shard-{}".format(shard), {})
+                       for shard in range(shards)]
+        projects = set(uuid.UUID(u) for checkpoint in checkpoints
+                       for u in checkpoint.get('refresh', []))
+        track_count = sum(checkpoint.get('tracks', 0)
+                          for checkpoint in checkpoints)
+        for shard, process in enumerate(processes):
+            if process.exitcode != 0:
+                print("[ERROR] Track shard {} failed.".format(shard))
+        complete = all(checkpoint.get('complete') for checkpoint in checkpoints)
+        if complete:
+            with self.db.atomic():
+                checkpoint = self.get_meta("tracklog", {})
+                projects |= set(uuid.UUID(u) for u in checkpoint.get('refresh', []))
+                self.set_meta("tracklog", {
+                    'watermark': last_id,
+                    'refresh': sorted(str(u) for u in projects)})
+                Meta.delete().where(Meta.id.in_([
+                    "tracklog-shard-{}".format(shard)
+                    for shard in range(shards)])).execute()
+        return complete, track_count, projects
+
+    def tracklog_shard(self, args, shard, shards, watermark, last_id, deadline):
+        """
+        Process the track entries of the shard, in the forked shard process.
+        Continuing from the shard checkpoint, when there's one. The maximum
+        rows to process are split among the shards.
+        """
+        self._db = None
+        checkpoint_id = "tracklog-shard-{}".format(shard)
+        checkpoint = self.get_meta(checkpoint_id, {})
+        if checkpoint.get('complete'):
+            # Nothing processed in this run.
+            self.set_meta(checkpoint_id, dict(checkpoint, tracks=0))
+            return
+        watermark = checkpoint.get('watermark', watermark)
+        projects = set(uuid.UUID(u) for u in checkpoint.get('refresh', []))
+        track_count = 0
+        max_rows = -(-args.max_rows // shards) if args.max_rows else 0
+        tracks = self.read_tracks(
+            watermark, last_id, Namespace(**dict(vars(args), max_rows=max_rows)),
+            (shard, shards))
+        for chunk in self.chunk_tracks(tracks, args.chunk_size, deadline):
+            if self.stopping.is_set():
+                break
+            counts = self.count_tracks(
+                chunk, args.stat_span, not args.skip_client_stats)
+            sketches = {}
+            if not args.skip_uniques:
+                sketches = self.sketch_tracks(chunk)
+            # SQLite has one writer at a time, which the transaction waits
+            # for up front.
+            with self.db.atomic() if self.db.is_mysql else self.db.atomic('IMMEDIATE'):
+                projects |= self.write_track_counts(counts, sketches)
+                track_count += len(chunk)
+                self.set_meta(checkpoint_id, {
+                    'watermark': chunk[-1][0],
+                    'tracks': track_count,
+                    'refresh': sorted(str(u) for u in projects)})
+        tracks.close()
+        # Stopped, out of time, or out of rows, before the last entry.
+        if self.stopping.is_set() or (deadline and time.perf_counter() >= deadline) \
+                or (max_rows and track_count >= max_rows):
+            return
+        self.set_meta(checkpoint_id, {
+            'watermark': last_id,
+            'tracks': track_count,
+            'refresh': sorted(str(u) for u in projects),
+            'complete': True})
+        self.db.close()
+
+    def chunk_tracks(self, tracks, chunk_size, deadline=None):
+        """
+        Split the track entries into lists of the chunk size. Stopping early
+        when past the deadline.
+        """
+        chunk = []
+        for track in tracks:
+            chunk.append(track)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+                if deadline and time.perf_counter() >= deadline:
+                    return
+        if chunk:
+            yield chunk
+
+    def count_tracks(self, tracks, stat_span, clients=True):
+        """
+        Count the downloads in the track entries for each package, time span,
+        and client when counting by clients.
+        """
+        counts = {}
+        for id, name, version, username, channel, revision, t, ua, uip in tracks:
+            key = (name, version, Track.identity(username, channel, revision),
+                   self.stat_span(t, stat_span),
+                   parse_client(ua) if clients else None)
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def sketch_tracks(self, tracks):
+        """
+        Sketch the unique downloaders, i.e. client IPs, in the track entries
+        for each package and day.
+        """
+        sketches = {}
+        for id, name, version, username, channel, revision, t, ua, uip in tracks:
+            key = (name, version, Track.identity(username, channel, revision),
+                   t.date())
+            sketch = sketches.get(key)
+            if not sketch:
+                sketch = sketches[key] = HyperLogLog()
+            sketch.add(uip)
+        return sketches
+
+    def write_track_counts(self, counts, sketches=None):
+        """
+        Add the download counts to the stats of their packages, and merge the
+        sketches of unique downloaders into theirs. Returns the uuids of the
+        projects of the packages.
+        """
+        projects = set()
+        packages = {}
+        # The stats get added after resolving all the packages. As adding
+        # writes out full batches, which belongs to the write phase.
+        stats = []
+        sketch_stats = []
+        with self.metrics.phase("resolve_projects"):
+            for (name, version, identity, (span_start, span_end), client), count in sorted(counts.items(), key=lambda c: c[0][0:4]):
+                # Find or create the project, and package, for the counts.
+                package = packages.get((name, version, identity))
+                if not package:
+                    if self.verbose:
+                        print("[INFO] Tracking for package: {}".format(
+                            (name, version, identity)))
+                    project = self.obtain_project(name, self.pdm_conan)
+                    projects.add(project)
+                    package = self.obtain_package(
+                        project, name, version, identity, self.pdm_conan)
+                    packages[(name, version, identity)] = package
+                stats.append((package, span_start, span_end, count,
+                              self.obtain_client(*client) if client else None))
+            for (name, version, identity, day), sketch in (sketches or {}).items():
+                span_start = datetime.datetime.combine(day, datetime.time())
+                sketch_stats.append((
+                    packages[(name, version, identity)],
+                    self.stat_span(span_start, 'day'), sketch))
+        with self.metrics.phase("write_stats"):
+            for package, span_start, span_end, count, client in stats:
+                self.stat_writer.add(
+                    *package, 'down', span_start, span_end, count)
+                self.popularity_writer.add(package[0], span_start, count)
+                if client:
+                    self.stat_writer.add(
+                        *package, 'dcli', span_start, span_end, count, client)
+            for package, span, sketch in sketch_stats:
+                self.sketch_writer.add(*package, *span, sketch)
+            self.stat_writer.flush()
+            self.latest_writer.flush()
+            self.sketch_writer.flush()
+            self.popularity_writer.flush()
+            if stats:
+                self.rewind_compact(min(stat[1] for stat in stats))
+        return projects
+
+    def rewind_compact(self, span_start):
+        """
+        Move the progress of the compact command back to the span of the
+        time, when it's past it already. Such that stats of late tracks, added
+        to spans that were compacted, get compacted again.
+        """
+        progress = self.get_meta("compact", {})
+        rewound = False
+        for span in list(progress.keys()):
+            start = self.stat_span(span_start, span)[0]
+            if start < datetime.datetime.fromisoformat(progress[span]):
+                progress[span] = start.isoformat()
+                rewound = True
+        if rewound:
+            self.set_meta("compact", progress)
+
+    def purge_tracks(self, watermark, batch_size, pause=0):
+        """
+        Delete the processed track log entries, those before the watermark.
+        The rows are deleted by ranges of ids, each in its own small
+        transaction with a pause in between. To avoid holding locks, and
+        growing the undo log, of the table the server keeps adding entries
+        to. When the table is partitioned by day the processed days are
+        dropped whole first. Returns the number of deleted rows.
+        """
+        deleted = 0
+        self.maintain_track_partitions(watermark)
+        while not self.stopping.is_set():
+            lower = Track.select(peewee.fn.MIN(Track.id)).scalar()
+            if lower is None or lower >= watermark:
+                break
+            upper = min(lower + batch_size, watermark)
+            with self.db.atomic():
+                deleted += Track.delete().where(
+                    Track.id >= lower, Track.id < upper).execute()
+            if pause:
+                self.stopping.wait(pause)
+        return deleted
+
+    # Number of days ahead to have track log partitions for.
+    track_partition_days = 7
+
+    @staticmethod
+    def to_days(date):
+        """
+        The MySQL `TO_DAYS` value of the date.
+        """
+        return date.toordinal() + 365
+
+    def track_partitions(self):
+        """
+        The day partitions of the track log table, as `(name, to_days)` pairs
+        of the day each partition ends before. With `None` for the catch all
+        partition. Empty when the table isn't partitioned.
+        """
+        if not self.db.is_mysql:
+            return []
+        cursor = self.db.execute_sql(
+            "SELECT `PARTITION_NAME`, `PARTITION_DESCRIPTION` "
+            "FROM `information_schema`.`PARTITIONS` "
+            "WHERE `TABLE_SCHEMA` = DATABASE() AND `TABLE_NAME` = %s "
+            "AND `PARTITION_NAME` IS NOT NULL "
+            "ORDER BY `PARTITION_ORDINAL_POSITION`",
+            (Track._meta.table_name,))
+        return [(name, None if less_than == 'MAXVALUE' else int(less_than))
+                for name, less_than in cursor.fetchall()]
+
+    def track_partition_defs(self, first, last):
+        """
+        The definitions of the partitions for the days from first to last.
+        """
+        result = []
+        day = first
+        while day <= last:
+            result.append("PARTITION `p{}` VALUES LESS THAN ({})".format(
+                day.strftime("%Y%m%d"),
+                self.to_days(day + datetime.timedelta(days=1))))
+            day += datetime.timedelta(days=1)
+        return result
+
+    def partition_tracks(self):
+        """
+        Partition the track log table by day. MySQL requires the partitioning
+        column to be part of the primary key, hence it's extended with the
+        time. All existing entries go into one partition for the past.
+        """
+        if not self.db.is_mysql:
+            print("[INFO] Partitioning of the track log is only supported for MySQL.")
+            return
+        if self.track_partitions():
+            print("[INFO] Track log is already partitioned.")
+            return
+        table = Track._meta.table_name
+        today = datetime.date.today()
+        print("[INFO] Partitioning track log by day.")
+        self.db.execute_sql(
+            "ALTER TABLE `{}` DROP PRIMARY KEY, ADD PRIMARY KEY (`id`, `t`)".format(table))
+        self.db.execute_sql(
+            "ALTER TABLE `{}` PARTITION BY RANGE (TO_DAYS(`t`)) ({})".format(
+                table, ", ".join(
+                    ["PARTITION `pold` VALUES LESS THAN ({})".format(
+                        self.to_days(today))] +
+                    self.track_partition_defs(
+                        today, today + datetime.timedelta(days=self.track_partition_days)) +
+                    ["PARTITION `pmax` VALUES LESS THAN MAXVALUE"])))
+
+    def maintain_track_partitions(self, watermark):
+        """
+        Drop the track log partitions that only have processed entries, i.e.
+        those for the days before the earliest entry from the watermark on.
+        And add partitions for the days ahead. Does nothing if the table isn't
+        partitioned.
+        """
+        partitions = self.track_partitions()
+        if not partitions:
+            return
+        table = Track._meta.table_name
+        today = datetime.date.today()
+        pending = Track.select(peewee.fn.MIN(Track.t)).where(
+            Track.id >= watermark).scalar()
+        done_before = self.to_days(pending.date() if pending else today)
+        drop = [name for name, less_than in partitions
+                if less_than and less_than <= done_before]
+        # There must always be one partition left, other than the catch all.
+        if len(drop) >= len(partitions) - 1:
+            drop = drop[:-1]
+        if drop:
+            print("[INFO] Dropping processed track log partitions:", *drop)
+            self.db.execute_sql("ALTER TABLE `{}` DROP PARTITION {}".format(
+                table, ", ".join("`{}`".format(name) for name in drop)))
+            self.metrics.count("track_partitions_dropped", len(drop))
+        # Split the new days off the catch all partition.
+        last_day = datetime.date.fromordinal(
+            max(less_than for name, less_than in partitions if less_than) - 365)
+        ahead = today + datetime.timedelta(days=self.track_partition_days)
+        if last_day <= ahead:
+            self.db.execute_sql(
+                "ALTER TABLE `{}` REORGANIZE PARTITION `pmax` INTO ({})".format(
+                    table, ", ".join(
+                        self.track_partition_defs(last_day, ahead) +
+                        ["PARTITION `pmax` VALUES LESS THAN MAXVALUE"])))
+
+    # The kinds of time span buckets statistics are aggregated into, from
+    # finest to coarsest.
+    stat_spans = ['hour', 'day', 'month']
+
+    def stat_span(self, t, span):
+        """
+        The `[start, end)` time span bucket, of the given span kind, that
+        contains the time `t`.
+        """
+        if span == 'month':
+            start = t.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+            end = (start + datetime.timedelta(days=32)).replace(day=1)
+        elif span == 'day':
+            start = t.replace(hour=0, minute=0, second=0, microsecond=0)
+            end = start + datetime.timedelta(days=1)
+        else:
+            start = t.replace(minute=0, second=0, microsecond=0)
+            end = start + datetime.timedelta(hours=1)
+        return (start, end)
+
+    # Index of all the packages, of the project for each package name, and of
+    # the latest version of each project.
+    _project_index = None
+    _package_index = None
+    _latest_index = None
+
+    def load_package_index(self):
+        """
+        Load the index of the projects and packages, if it isn't already. The
+        project index maps (name, packager) to the project uuid. The package
+        index maps the package keys to themselves, (project uuid, name,
+        version, identity, packager). Both by the keys as the database
+        compares them, see `Model.collation_key`. And the latest index maps
+        (project uuid, packager) to the (version_key, identity) of the latest
+        package.
+        """
+        if self._package_index is None:
+            self._project_index = {}
+            self._package_index = {}
+            self._latest_index = {}
+            packages = Package.select(
+                Package.project, Package.name, Package.version,
+                Package.identity, Package.packager).tuples()
+            for key in packages.iterator():
+                self._package_index[Package.collation_key(key)] = key
+                self._project_index.setdefault(
+                    Package.collation_key((key[1], key[4])), key[0])
+            latest = LatestPackage.select(
+                LatestPackage.project, LatestPackage.packager,
+                LatestPackage.version_key, LatestPackage.identity).tuples()
+            for project, packager, key, identity in latest.iterator():
+                self._latest_index[(project, packager)] = (key, identity)
+
+    _client_index = None
+
+    def obtain_client(self, name, os):
+        """
+        The id of the client, which gets created if needed. There are few of
+        them, so they are all kept in memory.
+        """
+        if self._client_index is None:
+            self._client_index = {
+                (c.name, c.os): c.id for c in Client.select().iterator()}
+        result = self._client_index.get((name, os))
+        if not result:
+            result = Client.insert(name=name, os=os).execute()
+            self._client_index[(name, os)] = result
+        return result
 
     def obtain_project(self, name, packager):
-        result = None
-        # Find an existing package that corresponds to the possible project.
-        try:
-            p = Package.get(
-                Package.name == name,
-                Package.packager == packager)
-            result = Project.get(Project.uuid == p.project)
-        except peewee.DoesNotExist:
-            # If we don't have an existing package, create a new project that
-            # that matches the package.
-            result = Project.create(uuid=uuid.uuid4(), name=name)
-        # print("[INFO] project:", result)
+        """
+        The uuid of the project for the package name. Creating a new project,
+        when there are no packages that correspond to it.
+        """
+        self.load_package_index()
+        key = Package.collation_key((name, packager))
+        result = self._project_index.get(key)
+        if result is None:
+            result = uuid.uuid4()
+            self.project_writer.add({
+                'uuid': result, 'name': name,
+                'updated': datetime.datetime.now()})
+            self._project_index[key] = result
         return result
 
     def obtain_package(self, project, name, version, identity, packager):
-        try:
-            result = Package.get(
-                Package.project == project,
-                Package.name == name,
-                Package.version == version,
-                Package.identity == identity,
-                Package.packager == packager)
-        except peewee.DoesNotExist:
-            result = Package.create(
-                project=project,
-                name=name, version=version, identity=identity, packager=packager)
-        # print("[INFO] package:", result)
+        """
+        The key of the package, i.e. (project uuid, name, version, identity,
+        packager). Creating a new package if it doesn't exist. The key is that
+        of the existing package, which may differ in case, when the database
+        considers them the same.
+        """
+        self.load_package_index()
+        result = (project, name, version, identity, packager)
+        collated = Package.collation_key(result)
+        if collated in self._package_index:
+            result = self._package_index[collated]
+        else:
+            self.package_writer.add({
+                'project': project,
+                'name': name, 'version': version, 'identity': identity,
+                'packager': packager})
+            self._package_index[collated] = result
+            # Keep track of the latest version package of the project. Which
+            # is also replaced by a new revision, i.e. identity, of the same
+            # version.
+            key = version_key(version)
+            latest_key, latest_identity = self._latest_index.get(
+                (project, packager), ("", None))
+            if key and (key > latest_key or (
+                    key == latest_key and identity != latest_identity)):
+                self.latest_writer.add({
+                    'project': project, 'packager': packager,
+                    'name': name, 'version': version, 'identity': identity,
+                    'version_key': key})
+                self._latest_index[(project, packager)] = (key, identity)
         return result
 
-    def refresh_project(self, project):
-        print("[INFO] Refresh project: {} #{}".format(
-            project.name, project.uuid))
+    def select_projects(self, uuids):
+        """
+        Iterate over the projects with the given uuids. Selected in batches
+        to limit the query size.
+        """
+        uuids = list(uuids)
+        for i in range(0, len(uuids), 500):
+            for project in Project.select().where(Project.uuid.in_(uuids[i:i+500])):
+                yield project
+
+    def refresh_projects(self, uuids, workers=1, timeout=None, cache=None):
+        """
+        Refresh the data of the projects from the info of their latest package
+        in the PDM. The info gets fetched for all the projects first, in
+        parallel with more than one worker. And then all the projects are
+        written out together. The optional cache is used for, and filled with,
+        the package info.
+        """
+        projects = list(self.select_projects(uuids))
+        if self.verbose:
+            for project in projects:
+                print("[INFO] Refresh project: {} #{}".format(
+                    project.name, project.uuid))
         # Find the current package, i.e. latest version, to obtain info from PDM.
-        packages = Package.select().where(Package.project == project.uuid,
-                                          Package.packager == self.pdm_conan)
-        latest_version = "0"
-        latest_package = None
-        for package in packages:
-            if semver.parse(package.version, True) and semver.gt(package.version, latest_version, True):
-                latest_version = package.version
-                latest_package = package
-        if latest_package:
-            # Obtain the details package info from PDM.
-            package_info = self.obtain_conan_package_info(latest_package)
-            if not package_info:
-                # Failed to find the package, or info. Ignore the update.
-                return
-            # Set project info from package.
-            project.description_brief = package_info['description']
-            project.topic = package_info['topics']
-            project.license = package_info['license']
-            project.info = package_info
+        latest_packages = self.select_latest_packages(uuids)
+        # Use the cached package info, when we have it.
+        package_infos = {}
+        if cache:
+            for project_uuid, package in list(latest_packages.items()):
+                package_info = cache.get(cache.key(
+                    package.name, package.version, package.identity))
+                if package_info:
+                    package_infos[project_uuid] = package_info
+                    del latest_packages[project_uuid]
+        # Obtain the details package info from PDM.
+        if self.args.pdm_client == "rest" and not self.args.pdm_stub:
+            # All fetched concurrently, over as many connections as workers.
+            package_infos.update(self.rest_client(workers).package_infos({
+                project_uuid: (package.name, package.version, package.identity)
+                for project_uuid, package in latest_packages.items()}, timeout))
+            if not self.watching:
+                self.close_rest_client()
+        elif workers > 1:
+            import multiprocessing
+            pool = self.worker_pool(workers)
+            keep_pool = False
+            try:
+                # Start all the fetches, and wait for them in order. Fetches
+                # that fail or take too long get ignored.
+                fetches = {}
+                for project_uuid, package in latest_packages.items():
+                    fetches[project_uuid] = pool.apply_async(
+                        timed_call,
+                        (self.pdm_package_info,
+                         package.name, package.version, package.identity))
+                for project_uuid, fetch in fetches.items():
+                    try:
+                        package_infos[project_uuid], seconds = fetch.get(
+                            timeout)
+                        self.metrics.observe("pdm_call", seconds)
+                    except multiprocessing.TimeoutError:
+                        print("[ERROR] Timed out fetching info for package",
+                              latest_packages[project_uuid].name, "ignoring.")
+                        # The worker may be stuck, start over with new ones.
+                        keep_pool = None
+                    except Exception as error:
+                        print("[ERROR] Failed fetching info for package",
+                              latest_packages[project_uuid].name, "ignoring:", error)
+                # Keep the workers, and their warm PDM API, for the next
+                # run when watching.
+                if keep_pool is not None:
+                    keep_pool = self.watching
+            finally:
+                if not keep_pool:
+                    self.close_worker_pool()
+        else:
+            for project_uuid, package in latest_packages.items():
+                package_infos[project_uuid], seconds = timed_call(
+                    self.obtain_conan_package_info, package)
+                self.metrics.observe("pdm_call", seconds)
+        if cache:
+            for project_uuid, package in latest_packages.items():
+                if package_infos.get(project_uuid):
+                    cache.put(cache.key(
+                        package.name, package.version, package.identity),
+                        package_infos[project_uuid])
+        # Write out the updated project data.
+        with self.db.atomic():
+            for project in projects:
+                self.refresh_project(project, package_infos.get(project.uuid))
+
+    _worker_pool = None
+
+    def worker_pool(self, workers):
+        """
+        The pool of processes to fetch PDM info with, created on first use.
+        """
+        if not self._worker_pool:
+            import multiprocessing
+            self._worker_pool = multiprocessing.Pool(workers)
+        return self._worker_pool
+
+    def close_worker_pool(self):
+        if self._worker_pool:
+            self._worker_pool.terminate()
+            self._worker_pool = None
+
+    _rest_client = None
+
+    def rest_client(self, connections):
+        """
+        The Conan REST API client, created on first use.
+        """
+        if not self._rest_client:
+            from .conan_rest import ConanRestClient
+            self._rest_client = ConanRestClient(
+                connections=max(connections, 1))
+        return self._rest_client
+
+    def close_rest_client(self):
+        if self._rest_client:
+            self._rest_client.close()
+            self._rest_client = None
+
+    def select_latest_packages(self, uuids):
+        """
+        The latest version Conan package for each of the projects with the
+        given uuids.
+        """
+        result = {}
+        uuids = list(uuids)
+        for i in range(0, len(uuids), 500):
+            packages = LatestPackage.select().where(
+                LatestPackage.project.in_(uuids[i:i+500]),
+                LatestPackage.packager == self.pdm_conan)
+            for package in packages:
+                result[package.project_id] = package
+        return result
+
+    def refresh_project(self, project, package_info):
+        """
+        Update, and save, the project data from the info of its latest package.
+        """
+        if not package_info:
+            # Failed to find the package, or info. Ignore the update.
+            return
+        # Nothing to do when the info is the same, which is most of the time.
+        # Compared as JSON, as stored, where the tuples of the info are lists.
+        package_info = json.loads(json.dumps(package_info))
+        if project.updated and project.info == package_info:
+            return
+        # Set project info from package.
+        project.description_brief = package_info['description']
+        project.topic = package_info['topics']
+        project.license = package_info['license']
+        project.info = package_info
+        project.updated = datetime.datetime.now()
         # Write out the updated project data.
         project.save()
 
@@ -348,42 +2191,17 @@ DB_PASSWORD, DB_DATABASE.
         Fetch the information for a package in a Conan remote repository.
         """
         assert(package.packager == self.pdm_conan)
-        conan_api: conans.client.conan_api.Conan = conans.client.conan_api.Conan.factory()[
-            0]
-        package_ref = "{}/{}@{}".format(package.name,
-                                        package.version, package.identity.split("#")[0])
-        package_attributes = [
-            'barbarian', 'name', 'version', 'url', 'homepage', 'license', 'author',
-            'description', 'topics', 'settings', 'options', 'default_options']
-        package_remote = "barbarian-github"
-        conan_api.config_set("general.revisions_enabled", "True")
-        conan_api.remote_add(
-            package_remote,
-            "https://barbarian.bfgroup.xyz/github",
-            force=True)
-        try:
-            package_info = conan_api.inspect(
-                package_ref, package_attributes, package_remote)
-        except conans.errors.NotFoundException:
-            print("[ERROR] Failed to inspect package",
-                  package_ref, "ignoring.")
-            return None
-        # Extract description if it's from an export file.
-        if 'barbarian' in package_info and 'description' in package_info['barbarian'] and 'file' in package_info['barbarian']['description']:
-            description_file = package_info['barbarian']['description']['file']
-            try:
-                description_text, _ = conan_api.get_path(
-                    package_ref,
-                    path=description_file,
-                    remote_name=package_remote)
-                if description_text:
-                    package_info['barbarian']['description']['text'] = description_text
-                    print("[INFO] Obtained description text for package",
-                          package_ref, "from export file", description_file)
-            finally:
-                # Ignore errors from fetching description data?
-                pass
-        return package_info
+        return self.pdm_package_info(
+            package.name, package.version, package.identity)
+
+    @property
+    def pdm_package_info(self):
+        """
+        The function to obtain package info with, from the PDM or the stub.
+        """
+        if self.args.pdm_stub:
+            return pdm.stub_package_info
+        return pdm.conan_package_info
 
 
 def main():
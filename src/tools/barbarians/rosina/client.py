@@ -0,0 +1,43 @@
+# Copyright 2022 René Ferdinand Rivera Morell
+# Distributed under the Boost Software License, Version 1.0.
+# (See accompanying file LICENSE.txt or http://www.boost.org/LICENSE_1_0.txt)
+
+import functools
+import re
+
+# The Conan user agent, "Conan/<version> (<details>) ...". Conan 2 puts the
+# operating system first in the details.
+conan_ua_re = re.compile(r'^Conan/(\d+)\.(\d+)[^ ]* \(([^;)]*)')
+
+# Operating system names, as Python reports them, to the ua-parser families.
+os_families = {
+    'Linux': 'Linux',
+    'Windows': 'Windows',
+    'Darwin': 'Mac OS X',
+    'FreeBSD': 'FreeBSD',
+    'SunOS': 'Solaris',
+}
+
+
+@functools.lru_cache(maxsize=10000)
+def parse_client(ua):
+    """
+    The `(name, os)` of the client from its user agent. There are few distinct
+    user agents compared to the number of track entries, hence the parse is
+    cached. The ua-parser doesn't know about Conan, so it's only used, and
+    imported, for the other clients.
+    """
+    if not ua:
+        return ("Other", "Other")
+    m = conan_ua_re.match(ua)
+    if m:
+        return ("Conan {}.{}".format(m.group(1), m.group(2)),
+                os_families.get(m.group(3), "Other"))
+    from ua_parser import user_agent_parser
+    parsed = user_agent_parser.Parse(ua)
+    name = parsed['user_agent']['family']
+    if parsed['user_agent']['major']:
+        name += " " + parsed['user_agent']['major']
+        if parsed['user_agent']['minor']:
+            name += "." + parsed['user_agent']['minor']
+    return (name[0:100], parsed['os']['family'][0:50])
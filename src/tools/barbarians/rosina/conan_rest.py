@@ -0,0 +1,258 @@
+# Copyright 2022 René Ferdinand Rivera Morell
+# Distributed under the Boost Software License, Version 1.0.
+# (See accompanying file LICENSE.txt or http://www.boost.org/LICENSE_1_0.txt)
+
+import ast
+import asyncio
+import io
+import json
+import posixpath
+import ssl
+import tarfile
+import urllib.parse
+from .pdm import conan_remote_url, conan_attributes
+
+
+class HTTPError(Exception):
+    def __init__(self, url, status):
+        super().__init__("HTTP {} for {}".format(status, url))
+        self.url = url
+        self.status = status
+
+
+class HTTPConnectionPool(object):
+    """
+    Minimal asyncio HTTP/1.1 client, for GET requests, that keeps the
+    connections to each server open to reuse them for later requests. At most
+    `size` requests are in progress at a time.
+    """
+
+    # The web tier doesn't track the downloads of this user agent.
+    user_agent = "barbarian-rosina"
+    max_redirects = 5
+
+    def __init__(self, size=4, timeout=60.0):
+        self.size = size
+        self.timeout = timeout
+        self.idle = {}
+        self.semaphore = None
+        self.ssl_context = None
+        self.connects = 0
+        self.requests = 0
+
+    async def get(self, url):
+        """
+        The `(status, headers, body)` response of the url. Following
+        redirects.
+        """
+        if not self.semaphore:
+            self.semaphore = asyncio.Semaphore(self.size)
+        async with self.semaphore:
+            for i in range(self.max_redirects + 1):
+                status, headers, body = await asyncio.wait_for(
+                    self.request(url), self.timeout)
+                if status in (301, 302, 303, 307, 308) and 'location' in headers:
+                    url = urllib.parse.urljoin(url, headers['location'])
+                    continue
+                return status, headers, body
+        raise HTTPError(url, status)
+
+    async def connect(self, key):
+        scheme, host, port = key
+        if scheme == 'https' and not self.ssl_context:
+            self.ssl_context = ssl.create_default_context()
+        self.connects += 1
+        return await asyncio.open_connection(
+            host, port, ssl=self.ssl_context if scheme == 'https' else None)
+
+    async def request(self, url):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname,
+               parts.port or (443 if parts.scheme == 'https' else 80))
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        request = (
+            "GET {} HTTP/1.1\r\nHost: {}\r\nUser-Agent: {}\r\n"
+            "Accept-Encoding: identity\r\nConnection: keep-alive\r\n\r\n").format(
+                path, parts.netloc, self.user_agent).encode('latin-1')
+        idle = self.idle.setdefault(key, [])
+        while True:
+            reused = bool(idle)
+            reader, writer = idle.pop() if reused else await self.connect(key)
+            try:
+                writer.write(request)
+                status, headers, body, keep_alive = await self.response(reader)
+                break
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                # The server may have closed an idle connection, in which case
+                # we try again with another. But not for a new one.
+                if not reused:
+                    raise
+            except BaseException:
+                # Cancelled, or failed, in the middle of the response.
+                writer.close()
+                raise
+        self.requests += 1
+        if keep_alive:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+        return status, headers, body
+
+    async def response(self, reader):
+        version, status, reason = (
+            await reader.readuntil(b"\r\n")).decode('latin-1').split(" ", 2)
+        headers = {}
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            name, value = line.decode('latin-1').split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+        keep_alive = version == "HTTP/1.1" and \
+            headers.get('connection', '').lower() != "close"
+        if headers.get('transfer-encoding', '').lower() == "chunked":
+            body = bytearray()
+            while True:
+                size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                if size == 0:
+                    # Skip the trailers.
+                    while await reader.readuntil(b"\r\n") != b"\r\n":
+                        pass
+                    break
+                body.extend(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = bytes(body)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()
+            keep_alive = False
+        return int(status), headers, body, keep_alive
+
+    def close(self):
+        for connections in self.idle.values():
+            for reader, writer in connections:
+                writer.close()
+        self.idle = {}
+
+
+def conanfile_attributes(source, attributes=conan_attributes):
+    """
+    The values of the attributes of the ConanFile class in the conanfile.py
+    source. Only the attributes with literal values are found, as the source
+    isn't run. The rest are `None`.
+    """
+    result = {attribute: None for attribute in attributes}
+    classes = [node for node in ast.parse(source).body
+               if isinstance(node, ast.ClassDef)]
+    # The recipe is the class derived from ConanFile, or the only one.
+    recipes = [c for c in classes if any(
+        "ConanFile" in ast.dump(base) for base in c.bases)] or classes[0:1]
+    for node in recipes[0].body if recipes else []:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and \
+                isinstance(node.targets[0], ast.Name) and \
+                node.targets[0].id in result:
+            try:
+                result[node.targets[0].id] = ast.literal_eval(node.value)
+            except ValueError:
+                pass
+    return result
+
+
+class ConanRestClient(object):
+    """
+    Client for the Conan v1 REST API of the Barbarian remote, to obtain the
+    package info directly from the recipe files. Instead of going through the
+    Conan client, which downloads and runs the recipe. The info of many
+    packages is fetched concurrently, over a pool of connections that's kept
+    between uses.
+    """
+
+    def __init__(self, remote_url=conan_remote_url, connections=4, timeout=60.0):
+        self.remote_url = remote_url.rstrip("/")
+        self.loop = asyncio.new_event_loop()
+        self.pool = HTTPConnectionPool(connections, timeout)
+
+    def close(self):
+        self.pool.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+
+    async def get(self, url):
+        status, headers, body = await self.pool.get(url)
+        if status != 200:
+            raise HTTPError(url, status)
+        return body
+
+    async def package_info(self, name, version, identity):
+        """
+        The info of the package, in the same form as the Conan inspect of
+        `pdm.conan_package_info`. Or `None` when the remote doesn't have it.
+        """
+        reference = "{}/{}/{}".format(name, version, identity.split("#")[0])
+        try:
+            urls = json.loads((await self.get("{}/v1/conans/{}/download_urls".format(
+                self.remote_url, urllib.parse.quote(reference)))).decode('utf-8'))
+        except HTTPError as error:
+            if error.status == 404:
+                print("[ERROR] Failed to find package", reference, "ignoring.")
+                return None
+            raise
+        package_info = conanfile_attributes(
+            (await self.get(urls['conanfile.py'])).decode('utf-8'))
+        package_info['name'] = package_info['name'] or name
+        package_info['version'] = package_info['version'] or version
+        # Fetch the description text, if it's from an export file.
+        barbarian = package_info['barbarian']
+        if isinstance(barbarian, dict) and isinstance(barbarian.get('description'), dict) and \
+                barbarian['description'].get('file'):
+            text = await self.export_file(urls, barbarian['description']['file'])
+            if text is not None:
+                barbarian['description']['text'] = text.decode('utf-8')
+        return package_info
+
+    async def export_file(self, urls, path):
+        """
+        The content of the exported file of the recipe, or `None` if there
+        isn't one. The exported files, other than the recipe and manifest,
+        are in the export archive.
+        """
+        if path in urls:
+            return await self.get(urls[path])
+        if 'conan_export.tgz' not in urls:
+            return None
+        archive = await self.get(urls['conan_export.tgz'])
+        with tarfile.open(fileobj=io.BytesIO(archive), mode="r:gz") as tar:
+            path = posixpath.normpath(path.replace("\\", "/"))
+            for member in tar.getmembers():
+                if member.isfile() and posixpath.normpath(member.name) == path:
+                    return tar.extractfile(member).read()
+        return None
+
+    def package_infos(self, packages, timeout=None):
+        """
+        The info of each of the packages, a dict of keys to `(name, version,
+        identity)`, as a dict of the keys to the info. Packages that fail, or
+        take longer than the timeout, are left out.
+        """
+        async def fetch(key, package):
+            try:
+                return key, await asyncio.wait_for(
+                    self.package_info(*package), timeout)
+            except asyncio.TimeoutError:
+                print("[ERROR] Timed out fetching info for package",
+                      package[0], "ignoring.")
+            except Exception as error:
+                print("[ERROR] Failed fetching info for package",
+                      package[0], "ignoring:", error)
+            return key, None
+
+        async def fetch_all():
+            return await asyncio.gather(
+                *[fetch(key, package) for key, package in packages.items()])
+
+        results = self.loop.run_until_complete(fetch_all())
+        return {key: info for key, info in results if info}
@@ -3,39 +3,141 @@
 # (See accompanying file LICENSE.txt or http://www.boost.org/LICENSE_1_0.txt)
 
 # import mysql.connector
+import functools
+import math
 import os
 import peewee
 import playhouse.mysql_ext
+import playhouse.pool
 import json
+import time
 import uuid
 
 from playhouse.mysql_ext import JSONField
+from .hll import HyperLogLog
 
 Models = []
 
 
+class QueryStats(object):
+    """
+    Mixin for peewee database classes that keeps count of the SQL queries
+    executed, and the time spent executing them.
+    """
+    query_count = 0
+    query_seconds = 0.0
+
+    def execute_sql(self, sql, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().execute_sql(sql, *args, **kwargs)
+        finally:
+            self.query_count += 1
+            self.query_seconds += time.perf_counter() - start
+
+
+class PooledConnectorDatabase(playhouse.pool.PooledDatabase):
+    """
+    Mixin for pooling MySQL, or MariaDB, connector connections. Connections
+    that got disconnected are replaced when taken from the pool.
+    """
+
+    def _is_closed(self, conn):
+        try:
+            if hasattr(conn, 'is_connected'):
+                return not conn.is_connected()
+            conn.ping()
+        except Exception:
+            return True
+        return False
+
+
+class PooledMySQLConnectorDatabase(
+        PooledConnectorDatabase, playhouse.mysql_ext.MySQLConnectorDatabase):
+    pass
+
+
+class PooledMariaDBConnectorDatabase(
+        PooledConnectorDatabase, playhouse.mysql_ext.MariaDBConnectorDatabase):
+    pass
+
+
 class Database(peewee.DatabaseProxy):
     """
     Manages Barbarian database connection initialized from env settings.
-    It optionally binds models to the database for immediate use.
+    It optionally binds models to the database for immediate use. And can
+    use a pool of connections, for long running processes.
     """
     __slots__ = ('obj', '_callbacks', '_models', '_bind')
 
-    def __init__(self, models=None, dbkind=None):
+    def __init__(self, models=None, dbkind=None, pooled=False):
         super().__init__()
+        pool_args = {}
+        if pooled:
+            pool_args = {'max_connections': 4, 'stale_timeout': 300}
         if not dbkind and os.getenv("DB_KIND") == "mariadb":
-            dbkind = playhouse.mysql_ext.MariaDBConnectorDatabase
+            dbkind = PooledMariaDBConnectorDatabase if pooled \
+                else playhouse.mysql_ext.MariaDBConnectorDatabase
         if not dbkind and os.getenv("DB_KIND") == "mysql":
-            dbkind = playhouse.mysql_ext.MySQLConnectorDatabase
-        database = dbkind(
-            os.getenv("DB_DATABASE"),
-            user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASSWORD"),
-            host=os.getenv("DB_HOST")
-        )
+            dbkind = PooledMySQLConnectorDatabase if pooled \
+                else playhouse.mysql_ext.MySQLConnectorDatabase
+        if not dbkind and os.getenv("DB_KIND") == "sqlite":
+            dbkind = playhouse.pool.PooledSqliteDatabase if pooled \
+                else peewee.SqliteDatabase
+        dbkind = type(dbkind.__name__, (QueryStats, dbkind), {})
+        if issubclass(dbkind, peewee.SqliteDatabase):
+            # A local file, or in memory, database. Mostly for testing.
+            database = dbkind(
+                os.getenv("DB_DATABASE") or ":memory:",
+                pragmas={'journal_mode': 'wal'},
+                **pool_args)
+        else:
+            database = dbkind(
+                os.getenv("DB_DATABASE"),
+                user=os.getenv("DB_USER"),
+                password=os.getenv("DB_PASSWORD"),
+                host=os.getenv("DB_HOST"),
+                **pool_args
+            )
         self.initialize(database)
         self.bind(Models)
 
+    @property
+    def is_mysql(self):
+        return isinstance(self.obj, peewee.MySQLDatabase)
+
+    def stream(self, query, fields, batch_size=1000):
+        """
+        Iterate over the rows, as tuples of the fields, of a select query. The
+        query runs on a connection of its own, and for MySQL with an unbuffered
+        cursor. Hence rows are read from the server as they are consumed.
+        """
+        if not self.is_mysql:
+            # Other databases, i.e. SQLite, read the rows as they are consumed
+            # already.
+            for row in query.tuples().iterator():
+                yield row
+            return
+        database = type(self.obj)(self.obj.database, **self.obj.connect_params)
+        database.connect()
+        try:
+            if isinstance(database, (
+                    playhouse.mysql_ext.MySQLConnectorDatabase,
+                    playhouse.mysql_ext.MariaDBConnectorDatabase)):
+                cursor = database.connection().cursor(buffered=False)
+            else:
+                cursor = database.connection().cursor()
+            converters = [f.python_value for f in fields]
+            sql, params = query.sql()
+            cursor.execute(sql, params)
+            rows = cursor.fetchmany(batch_size)
+            while rows:
+                for row in rows:
+                    yield tuple(c(v) for c, v in zip(converters, row))
+                rows = cursor.fetchmany(batch_size)
+        finally:
+            database.close()
+
 
 class TagsField(peewee.UUIDField):
     """
@@ -64,6 +166,26 @@ class Model(peewee.Model):
     class Meta:
         table_function = barbarian_table_name
 
+    @classmethod
+    def is_mysql(cls):
+        database = cls._meta.database
+        if isinstance(database, peewee.DatabaseProxy):
+            database = database.obj
+        return isinstance(database, peewee.MySQLDatabase)
+
+    @classmethod
+    def collation_key(cls, key):
+        """
+        The key, a tuple of values, in the form the database compares them.
+        For matching rows in memory the same as the database does. MySQL, with
+        the default collation, compares strings case insensitive and ignoring
+        trailing spaces.
+        """
+        if not cls.is_mysql():
+            return key
+        return tuple(
+            v.lower().rstrip(" ") if isinstance(v, str) else v for v in key)
+
 
 class Meta(Model):
     """
@@ -73,7 +195,7 @@ class Meta(Model):
     id = peewee.CharField(max_length=100, primary_key=True)  # varchar(100)
     value = JSONField(null=True)  # JSON
 
-    version = {"schema": "2"}
+    version = {"schema": "9"}
 
 
 Models.append(Meta)
@@ -83,7 +205,7 @@ class Track(Model):
     """
     Tracking log entries of access to Barbarian server.
     """
-    id = peewee.BigIntegerField(primary_key=True)  # bigint(20)
+    id = peewee.BigAutoField()  # bigint(20)
     package_name = peewee.CharField(max_length=100)  # varchar(100)
     package_version = peewee.CharField(max_length=100)  # varchar(100)
     package_username = peewee.CharField(
@@ -98,11 +220,16 @@ class Track(Model):
 
     @property
     def package_identity(self):
+        return Track.identity(
+            self.package_username, self.package_channel, self.revision)
+
+    @staticmethod
+    def identity(username, channel, revision):
         result = '{}/{}'.format(
-            self.package_username if self.package_username else "_",
-            self.package_channel if self.package_channel else "_")
-        if self.revision:
-            result += "#"+self.revision
+            username if username else "_",
+            channel if channel else "_")
+        if revision:
+            result += "#"+revision
         return result
 
 
@@ -162,11 +289,76 @@ class Package(Model):
 Models.append((Package))
 
 
+@functools.lru_cache(maxsize=10000)
+def version_key(version):
+    """
+    A string for the version that sorts in semver precedence order. Or None
+    if the version is not a, loose, semver. The prerelease identifiers are
+    separated by a NUL, which sorts before any identifier character. Such
+    that an identifier sorts before the longer ones it's a prefix of.
+    """
+    import semver
+    v = semver.parse(version, True)
+    if not v:
+        return None
+    result = "{:010d}.{:010d}.{:010d}".format(v.major, v.minor, v.patch)
+    if v.prerelease:
+        result += "-" + "\x00".join(
+            "0{:010d}".format(p) if isinstance(p, int) else "1"+p
+            for p in v.prerelease)
+    else:
+        result += "~"
+    return result[0:100]
+
+
+class LatestPackage(Model):
+    """
+    The package with the latest version of a project in a PDM. Kept up to date
+    as packages are added.
+    """
+    project = peewee.ForeignKeyField(
+        Project, column_name='project')  # varchar(40)
+    # The PDM for the package, only "Conan" so far.
+    packager = peewee.CharField(max_length=30)  # varchar(30)
+    # Package name for the PDM.
+    name = peewee.CharField(max_length=100)  # varchar(100)
+    # Version in form needed for the package.
+    version = peewee.CharField(max_length=100)  # varchar(100)
+    # Identity of the package, see Package.identity.
+    identity = peewee.CharField(max_length=300, null=True)  # varchar(300)
+    # The version_key of the version.
+    version_key = peewee.CharField(max_length=100)  # varchar(100)
+
+    class Meta:
+        primary_key = peewee.CompositeKey('project', 'packager')
+
+
+Models.append(LatestPackage)
+
+
+class Client(Model):
+    """
+    The kind of client, i.e. tool and operating system, that accessed the
+    Barbarian server. For breaking down statistics by client.
+    """
+    id = peewee.AutoField()  # int(11)
+    # Name and major.minor version of the tool, for example "Conan 1.51".
+    name = peewee.CharField(max_length=100)  # varchar(100)
+    # The operating system family, or "Other" when unknown.
+    os = peewee.CharField(max_length=50)  # varchar(50)
+
+    class Meta:
+        indexes = ((('name', 'os'), True),)
+
+
+Models.append(Client)
+
+
 class Stat(Model):
     """
     Single entry for a package statistic value.
     """
-    id = peewee.BigIntegerField(primary_key=True)  # bigint(20)
+    id = peewee.BigAutoField()  # bigint(20)
     project = peewee.ForeignKeyField(
         Project, backref="packages", column_name='project')  # varchar(40)
     # Package name for the PDM.
@@ -185,10 +377,343 @@ class Stat(Model):
     span_end = peewee.DateTimeField()  # datatime
     # The stat key ID.
     stat = peewee.FixedCharField(max_length=4, choices=[
-        ('down', 'downloads')
+        ('down', 'downloads'),
+        ('dcli', 'downloads by client')
     ])  # char(4)
     # The stat value, if it's a decimal.
     value_i = peewee.BigIntegerField()  # bigint(20)
+    # The Client the stat is for, or zero for all clients.
+    client = peewee.IntegerField(default=0)  # int(11)
+
+    class Meta:
+        # There's one stat per package, stat key, time span, and client. Which
+        # is also how the StatWriter finds the stats to add to.
+        indexes = ((('project', 'package_name', 'package_version',
+                     'package_identity', 'packager', 'stat', 'span_start',
+                     'span_end', 'client'), True),)
 
 
 Models.append(Stat)
+
+
+class Sketch(Model):
+    """
+    HyperLogLog sketch of the distinct downloaders, i.e. client IPs, of a
+    package within a time span. Sketches of the same package are merged to
+    estimate the unique downloaders over longer time spans.
+    """
+    id = peewee.BigAutoField()  # bigint(20)
+    project = peewee.ForeignKeyField(
+        Project, column_name='project')  # varchar(40)
+    # Package name for the PDM.
+    package_name = peewee.CharField(max_length=100)  # varchar(100)
+    # Version in form needed for the package.
+    package_version = peewee.CharField(max_length=100)  # varchar(100)
+    # Identity of the package, see Package.identity.
+    package_identity = peewee.CharField(
+        max_length=300, null=True)  # varchar(300)
+    # The PDM for the package, only "Conan" so far.
+    packager = peewee.CharField(max_length=30)  # varchar(30)
+    # Time span that the sketch applies to.
+    span_start = peewee.DateTimeField()  # datatime
+    span_end = peewee.DateTimeField()  # datatime
+    # The compressed HyperLogLog registers.
+    sketch = peewee.BlobField()  # blob
+
+    class Meta:
+        # There's one sketch per package and time span. Which is how the
+        # SketchWriter finds the sketches to merge into. The package name
+        # comes first, as the uniques of a package are selected by it.
+        indexes = ((('package_name', 'package_version', 'package_identity',
+                     'packager', 'project', 'span_start', 'span_end'), True),)
+
+
+Models.append(Sketch)
+
+
+class Popularity(Model):
+    """
+    Popularity of a project, as its total downloads and trending scores of
+    exponentially decayed downloads. The scores use forward decay: downloads
+    are weighted by `exp((t - epoch) / window)`, with the epoch in the
+    "popularity" Meta entry, instead of decaying the existing scores. Hence
+    the scores only need adding to, and sort the same as the decayed
+    downloads at any time. Which is the score times
+    `exp(-(now - epoch) / window)`.
+    """
+    project = peewee.ForeignKeyField(
+        Project, primary_key=True, column_name='project')  # varchar(40)
+    # All time downloads.
+    downloads = peewee.BigIntegerField(default=0)  # bigint(20)
+    # Downloads decayed over a week.
+    trend_week = peewee.DoubleField(default=0, index=True)  # double
+    # Downloads decayed over a month.
+    trend_month = peewee.DoubleField(default=0, index=True)  # double
+
+    # The days the scores decay over.
+    windows = {'trend_week': 7, 'trend_month': 30}
+
+    @staticmethod
+    def weights(t, epoch):
+        """
+        The weights, for each of the trending scores, of downloads at time t.
+        """
+        days = (t - epoch).total_seconds() / (24*60*60)
+        return {field: math.exp(days / window)
+                for field, window in Popularity.windows.items()}
+
+
+Models.append(Popularity)
+
+
+class BatchWriter(object):
+    """
+    Buffers new rows of a model to write them to the database with multi-row
+    inserts, in chunks of the batch size. Or replacing existing rows, with
+    the same primary key. Or ignoring the rows that already exist. The
+    writers this one depends on, i.e. for foreign keys, get flushed before
+    this one.
+    """
+
+    def __init__(self, model, batch_size=500, depends=None, replace=False,
+                 ignore=False):
+        self.model = model
+        self.batch_size = batch_size
+        self.depends = depends or []
+        self.replace = replace
+        self.ignore = ignore
+        self.rows = []
+        # Totals of the rows written, and the time spent writing them.
+        self.written = 0
+        self.seconds = 0.0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, row):
+        """
+        Add a row, a dict of field values, to write. Which flushes the buffered
+        rows when the batch is full.
+        """
+        self.rows.append(row)
+        if len(self) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        for depend in self.depends:
+            depend.flush()
+        if len(self) == 0:
+            return
+        start = time.perf_counter()
+        self.write()
+        self.seconds += time.perf_counter() - start
+        self.rows = []
+
+    def write(self):
+        for i in range(0, len(self.rows), self.batch_size):
+            batch = self.rows[i:i+self.batch_size]
+            if self.replace:
+                self.model.replace_many(batch).execute()
+            elif self.ignore:
+                self.model.insert_many(batch).on_conflict_ignore().execute()
+            else:
+                self.model.insert_many(batch).execute()
+            self.written += len(batch)
+
+
+class StatWriter(BatchWriter):
+    """
+    Buffers stat values to add to the existing stats, or to write as new stats.
+    Values for the same stat and time span get summed before writing.
+    """
+
+    key_fields = [
+        'project', 'package_name', 'package_version', 'package_identity',
+        'packager', 'stat', 'span_start', 'span_end', 'client']
+
+    def __init__(self, batch_size=500, depends=None):
+        super().__init__(Stat, batch_size, depends)
+        self.values = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, project, package_name, package_version, package_identity,
+            packager, stat, span_start, span_end, value, client=0):
+        key = (project, package_name, package_version, package_identity,
+               packager, stat, span_start, span_end, client)
+        self.values[key] = self.values.get(key, 0) + value
+        if len(self) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        super().flush()
+        self.values = {}
+
+    def write(self):
+        keys = list(self.values.keys())
+        key_columns = [getattr(Stat, f) for f in self.key_fields]
+        for i in range(0, len(keys), self.batch_size):
+            # The values of keys the database considers the same get summed.
+            values = {}
+            for key in keys[i:i+self.batch_size]:
+                collated = Stat.collation_key(key)
+                if collated in values:
+                    values[collated][1] += self.values[key]
+                else:
+                    values[collated] = [key, self.values[key]]
+            # Find which of the stats already exist, to add to them. Grouping
+            # the additions by value to update them together.
+            updates = {}
+            batch_values = [
+                tuple(c.db_value(v) for c, v in zip(key_columns, key))
+                for key, value in values.values()]
+            existing = Stat.select(Stat.id, *key_columns).where(
+                peewee.Tuple(*key_columns).in_(batch_values)).tuples()
+            for row in existing:
+                entry = values.pop(Stat.collation_key(tuple(row[1:])), None)
+                if entry:
+                    updates.setdefault(entry[1], []).append(row[0])
+            for value, ids in updates.items():
+                Stat.update(value_i=Stat.value_i + value).where(
+                    Stat.id.in_(ids)).execute()
+                self.written += len(ids)
+            # And the rest are new stats. Which get added to, instead of
+            # failing the whole batch, if they were added meanwhile.
+            rows = []
+            for key, value in values.values():
+                row = dict(zip(self.key_fields, key))
+                row['value_i'] = value
+                rows.append(row)
+            if rows:
+                if Stat.is_mysql():
+                    on_conflict = dict(update={
+                        Stat.value_i: Stat.value_i + peewee.fn.VALUES(Stat.value_i)})
+                else:
+                    on_conflict = dict(conflict_target=key_columns, update={
+                        Stat.value_i: Stat.value_i + peewee.EXCLUDED.value_i})
+                Stat.insert_many(rows).on_conflict(**on_conflict).execute()
+                self.written += len(rows)
+
+
+class SketchWriter(BatchWriter):
+    """
+    Buffers sketches to merge into the existing sketches, or to write as new
+    sketches. Sketches for the same package and time span get merged before
+    writing.
+    """
+
+    key_fields = [
+        'project', 'package_name', 'package_version', 'package_identity',
+        'packager', 'span_start', 'span_end']
+
+    def __init__(self, batch_size=500, depends=None):
+        super().__init__(Sketch, batch_size, depends)
+        self.sketches = {}
+
+    def __len__(self):
+        return len(self.sketches)
+
+    def add(self, project, package_name, package_version, package_identity,
+            packager, span_start, span_end, sketch):
+        key = (project, package_name, package_version, package_identity,
+               packager, span_start, span_end)
+        if key in self.sketches:
+            self.sketches[key].merge(sketch)
+        else:
+            self.sketches[key] = sketch
+        if len(self) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        super().flush()
+        self.sketches = {}
+
+    def write(self):
+        keys = list(self.sketches.keys())
+        key_columns = [getattr(Sketch, f) for f in self.key_fields]
+        for i in range(0, len(keys), self.batch_size):
+            # The sketches of keys the database considers the same get merged.
+            sketches = {}
+            for key in keys[i:i+self.batch_size]:
+                collated = Sketch.collation_key(key)
+                if collated in sketches:
+                    sketches[collated][1].merge(self.sketches[key])
+                else:
+                    sketches[collated] = [key, self.sketches[key]]
+            # Merge into the sketches that already exist, and replace them
+            # with the merged ones.
+            batch_values = [
+                tuple(c.db_value(v) for c, v in zip(key_columns, key))
+                for key, sketch in sketches.values()]
+            existing = Sketch.select(Sketch.id, Sketch.sketch, *key_columns).where(
+                peewee.Tuple(*key_columns).in_(batch_values)).tuples()
+            rows = []
+            for row in existing:
+                entry = sketches.pop(Sketch.collation_key(tuple(row[2:])), None)
+                if entry:
+                    sketch = HyperLogLog.from_bytes(row[1]).merge(entry[1])
+                    rows.append(dict(zip(self.key_fields, row[2:])))
+                    rows[-1]['id'] = row[0]
+                    rows[-1]['sketch'] = sketch.to_bytes()
+            if rows:
+                Sketch.replace_many(rows).execute()
+                self.written += len(rows)
+            # And the rest are new sketches.
+            rows = []
+            for key, sketch in sketches.values():
+                row = dict(zip(self.key_fields, key))
+                row['sketch'] = sketch.to_bytes()
+                rows.append(row)
+            if rows:
+                Sketch.insert_many(rows).execute()
+                self.written += len(rows)
+
+
+class PopularityWriter(BatchWriter):
+    """
+    Buffers downloads of projects to add to their popularity.
+    """
+
+    def __init__(self, epoch, batch_size=500, depends=None):
+        super().__init__(Popularity, batch_size, depends)
+        self.epoch = epoch
+        self.deltas = {}
+
+    def __len__(self):
+        return len(self.deltas)
+
+    def add(self, project, t, downloads):
+        delta = self.deltas.get(project)
+        if not delta:
+            delta = self.deltas[project] = {
+                'downloads': 0, 'trend_week': 0.0, 'trend_month': 0.0}
+        delta['downloads'] += downloads
+        for field, weight in Popularity.weights(t, self.epoch).items():
+            delta[field] += downloads * weight
+        if len(self) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        super().flush()
+        self.deltas = {}
+
+    def write(self):
+        projects = list(self.deltas.keys())
+        for i in range(0, len(projects), self.batch_size):
+            rows = []
+            existing = Popularity.select().where(
+                Popularity.project.in_(projects[i:i+self.batch_size]))
+            for popularity in existing:
+                delta = self.deltas.pop(popularity.project_id)
+                rows.append({
+                    'project': popularity.project_id,
+                    'downloads': popularity.downloads + delta['downloads'],
+                    'trend_week': popularity.trend_week + delta['trend_week'],
+                    'trend_month': popularity.trend_month + delta['trend_month']})
+            for project in projects[i:i+self.batch_size]:
+                if project in self.deltas:
+                    rows.append(dict(self.deltas[project], project=project))
+            if rows:
+                Popularity.replace_many(rows).execute()
+                self.written += len(rows)
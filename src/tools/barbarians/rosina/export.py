@@ -0,0 +1,99 @@
+# Copyright 2022 René Ferdinand Rivera Morell
+# Distributed under the Boost Software License, Version 1.0.
+# (See accompanying file LICENSE.txt or http://www.boost.org/LICENSE_1_0.txt)
+
+import gzip
+import hashlib
+import io
+import json
+import os
+
+
+class SnapshotExport(object):
+    """
+    Directory of gzip compressed JSON snapshot files, for the web tier to
+    serve as static files. Each file has a content hash, to use as ETag, that
+    is recorded in the "manifest.json" file. Along with a "delta.json" file of
+    the changes of the last export. The files are written atomically, and
+    only when their content changed.
+    """
+
+    manifest_name = "manifest.json"
+    delta_name = "delta.json"
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest = self.read_json(self.manifest_name) or {
+            'generation': 0, 'exported': None, 'files': {}}
+        self.changed = {}
+        self.removed = []
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def read_json(self, name):
+        try:
+            with open(self.path(name), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def replace(self, name, data):
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    def etag(self, name):
+        entry = self.manifest['files'].get(name)
+        return entry['etag'] if entry else None
+
+    def write(self, name, document, **extra):
+        """
+        Write the document, as gzip compressed JSON, to the named file. Unless
+        the content is the same as what's there already. Returns True when
+        the file changed. The extra values are recorded in the manifest.
+        """
+        data = json.dumps(
+            document, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        etag = hashlib.sha256(data).hexdigest()[0:32]
+        entry = dict(extra, etag=etag)
+        if etag == self.etag(name):
+            self.manifest['files'][name] = entry
+            return False
+        # The gzip time is fixed, to have the same bytes for the same content.
+        compressed = io.BytesIO()
+        with gzip.GzipFile(filename="", mode="wb", fileobj=compressed, mtime=0) as f:
+            f.write(data)
+        entry['size'] = len(compressed.getvalue())
+        self.replace(name, compressed.getvalue())
+        self.manifest['files'][name] = entry
+        self.changed[name] = etag
+        return True
+
+    def remove(self, name):
+        if self.manifest['files'].pop(name, None) is not None:
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+            self.removed.append(name)
+
+    def finish(self, exported):
+        """
+        Write the manifest, and the delta from the previous export, when any
+        of the files changed.
+        """
+        previous = self.manifest['generation']
+        self.manifest['exported'] = exported
+        if self.changed or self.removed:
+            self.manifest['generation'] = previous + 1
+            self.replace(self.delta_name, json.dumps({
+                'generation': self.manifest['generation'],
+                'previous': previous,
+                'changed': self.changed,
+                'removed': sorted(self.removed),
+            }, sort_keys=True, indent=1).encode('utf-8'))
+        self.replace(self.manifest_name, json.dumps(
+            self.manifest, sort_keys=True, indent=1).encode('utf-8'))
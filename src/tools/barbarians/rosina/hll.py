@@ -0,0 +1,75 @@
+# Copyright 2022 René Ferdinand Rivera Morell
+# Distributed under the Boost Software License, Version 1.0.
+# (See accompanying file LICENSE.txt or http://www.boost.org/LICENSE_1_0.txt)
+
+import hashlib
+import math
+import re
+import zlib
+
+
+class HyperLogLog(object):
+    """
+    HyperLogLog sketch to estimate the number of distinct values added to it.
+    It has a fixed size, of `2**p` one byte registers, independent of the
+    number of values. With the default `p` of 12 that's 4 KB, and an error of
+    about 1.6%. Sketches can be merged to estimate the distinct values of the
+    union of their values.
+    """
+
+    def __init__(self, p=12, registers=None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(registers or self.m)
+
+    @staticmethod
+    def hash(value):
+        return int.from_bytes(hashlib.blake2b(
+            value.encode('utf-8'), digest_size=8).digest(), 'little')
+
+    def add(self, value):
+        h = self.hash(value)
+        # The top p bits select the register, which keeps the maximum
+        # position of the first one bit of the rest.
+        i = h >> (64 - self.p)
+        rank = (64 - self.p) - (h & ((1 << (64 - self.p)) - 1)).bit_length() + 1
+        if rank > self.registers[i]:
+            self.registers[i] = rank
+
+    nonzero_re = re.compile(b'[^\x00]')
+
+    def merge(self, other):
+        """
+        Merge the other sketch into this one. Which is quicker when the other
+        sketch is the one with fewer values.
+        """
+        if self.m - other.registers.count(0) < self.m // 8:
+            registers = self.registers
+            for match in self.nonzero_re.finditer(other.registers):
+                i = match.start()
+                if registers[i] < other.registers[i]:
+                    registers[i] = other.registers[i]
+        else:
+            self.registers = bytearray(
+                map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        """
+        The estimated number of distinct values.
+        """
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / sum(
+            2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros:
+            # Small range correction, with linear counting.
+            estimate = self.m * math.log(self.m / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        return zlib.compress(bytes(self.registers))
+
+    @classmethod
+    def from_bytes(cls, data, p=12):
+        return cls(p, zlib.decompress(data))
@@ -0,0 +1,186 @@
+# Copyright 2022 René Ferdinand Rivera Morell
+# Distributed under the Boost Software License, Version 1.0.
+# (See accompanying file LICENSE.txt or http://www.boost.org/LICENSE_1_0.txt)
+
+import math
+import mmap
+import os
+import re
+import struct
+import uuid
+
+# The weight of the terms in each of the project fields.
+field_weights = {'name': 3.0, 'topic': 2.0, 'description': 1.0}
+
+term_re = re.compile(r'[a-z0-9]+')
+
+
+def tokenize(text):
+    """
+    The search terms in the text.
+    """
+    return term_re.findall(text.lower()) if text else []
+
+
+def project_terms(name, description, topics):
+    """
+    The terms of a project, with the weight of the best field each is in.
+    """
+    terms = {}
+    for field, words in (
+            ('description', tokenize(description)),
+            ('topic', [t for topic in (topics or []) for t in tokenize(topic)]),
+            ('name', tokenize(name))):
+        for term in words:
+            terms[term] = max(terms.get(term, 0.0), field_weights[field])
+    return terms
+
+
+class SearchIndex(object):
+    """
+    Inverted index of projects, in a file that's used memory mapped. The file
+    has a header, with the format version and the sizes of the sections,
+    followed by the sections: the projects, the terms sorted to find terms
+    and term prefixes with a binary search, the postings of each term, and
+    the strings the others refer to.
+    """
+
+    magic = b'RSI1'
+    version = 1
+    # Magic, version, and counts of projects, terms, and postings.
+    header = struct.Struct("<4sIIII")
+    # Project: uuid, name and license string offset and length, and
+    # popularity weight.
+    project = struct.Struct("<16sIHIHf")
+    # Term: string offset and length, and the first posting and count.
+    term = struct.Struct("<IHII")
+    # Posting: project index, and term weight.
+    posting = struct.Struct("<If")
+
+    @classmethod
+    def write(cls, path, projects):
+        """
+        Write the index of the projects, a dict of uuid to `(name, license,
+        popularity, terms)`, to the file. The file is replaced atomically, so
+        that readers keep a consistent index.
+        """
+        strings = bytearray()
+
+        def string(s):
+            s = (s or "").encode('utf-8')[0:0xFFFF]
+            offset = len(strings)
+            strings.extend(s)
+            return offset, len(s)
+
+        project_records = []
+        postings = {}
+        for i, (project_uuid, (name, license, popularity, terms)) in enumerate(
+                sorted(projects.items())):
+            project_records.append(cls.project.pack(
+                uuid.UUID(project_uuid).bytes, *string(name), *string(license),
+                math.log1p(popularity or 0.0)))
+            for term, weight in terms.items():
+                postings.setdefault(term, []).append((i, weight))
+        term_records = []
+        posting_records = []
+        for term in sorted(postings, key=lambda t: t.encode('utf-8')):
+            term_records.append(cls.term.pack(
+                *string(term), len(posting_records), len(postings[term])))
+            posting_records.extend(
+                cls.posting.pack(*p) for p in postings[term])
+        with open(path + ".tmp", "wb") as f:
+            f.write(cls.header.pack(
+                cls.magic, cls.version, len(project_records),
+                len(term_records), len(posting_records)))
+            f.write(b''.join(project_records))
+            f.write(b''.join(term_records))
+            f.write(b''.join(posting_records))
+            f.write(strings)
+        os.replace(path + ".tmp", path)
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.project_count, self.term_count, posting_count = \
+            self.header.unpack_from(self.data)
+        if magic != self.magic or version != self.version:
+            raise ValueError(
+                "Unsupported search index file format: {}".format(path))
+        self.projects_offset = self.header.size
+        self.terms_offset = self.projects_offset + \
+            self.project_count * self.project.size
+        self.postings_offset = self.terms_offset + \
+            self.term_count * self.term.size
+        self.strings_offset = self.postings_offset + \
+            posting_count * self.posting.size
+
+    def close(self):
+        self.data.close()
+
+    def string(self, offset, length):
+        start = self.strings_offset + offset
+        return bytes(self.data[start:start+length])
+
+    def term_at(self, i):
+        offset, length, first, count = self.term.unpack_from(
+            self.data, self.terms_offset + i * self.term.size)
+        return self.string(offset, length), first, count
+
+    def lower_bound(self, term):
+        lo, hi = 0, self.term_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.term_at(mid)[0] < term:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def postings(self, term, prefix=False):
+        """
+        The weight of the term for each project index. Or the best weight of
+        the terms that start with the term, for a prefix.
+        """
+        term = term.encode('utf-8')
+        result = {}
+        i = self.lower_bound(term)
+        while i < self.term_count:
+            t, first, count = self.term_at(i)
+            if not (t.startswith(term) if prefix else t == term):
+                break
+            for p, weight in self.posting.iter_unpack(self.data[
+                    self.postings_offset + first * self.posting.size:
+                    self.postings_offset + (first + count) * self.posting.size]):
+                result[p] = max(result.get(p, 0.0), weight)
+            i += 1
+        return result
+
+    def search(self, text, limit=20):
+        """
+        The projects that have all the terms of the text, with the last term
+        as a prefix, best matches first. Each is a dict of the project
+        `uuid`, `name`, `license`, and `score`.
+        """
+        terms = tokenize(text)
+        if not terms:
+            return []
+        scores = None
+        for i, term in enumerate(terms):
+            postings = self.postings(term, prefix=i == len(terms) - 1)
+            if scores is None:
+                scores = postings
+            else:
+                scores = {p: s + postings[p]
+                          for p, s in scores.items() if p in postings}
+        results = []
+        for p, score in scores.items():
+            project_uuid, name_offset, name_length, license_offset, license_length, popularity = \
+                self.project.unpack_from(
+                    self.data, self.projects_offset + p * self.project.size)
+            results.append({
+                'uuid': str(uuid.UUID(bytes=project_uuid)),
+                'name': self.string(name_offset, name_length).decode('utf-8'),
+                'license': self.string(license_offset, license_length).decode('utf-8'),
+                'score': score * (1.0 + popularity)})
+        results.sort(key=lambda r: (-r['score'], r['name']))
+        return results[0:limit]
@@ -0,0 +1,94 @@
+# Copyright 2022 René Ferdinand Rivera Morell
+# Distributed under the Boost Software License, Version 1.0.
+# (See accompanying file LICENSE.txt or http://www.boost.org/LICENSE_1_0.txt)
+
+import datetime
+import gzip
+import hashlib
+import json
+from .db import Track
+
+# The track fields of the access log entries, other than the time.
+track_fields = [
+    'package_name', 'package_version', 'package_username', 'package_channel',
+    'revision', 'dp', 'ua', 'uip']
+
+time_formats = ["%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S"]
+
+
+def track_entry(line):
+    """
+    The Track row of an access log line. Which is a JSON object of the track
+    fields, and the time `t` in ISO format in UTC. The time is converted to
+    local time, as the track times of the database default, and of the
+    tracklog, are local. Raises ValueError for invalid lines.
+    """
+    entry = json.loads(line.decode('utf-8'))
+    if not isinstance(entry, dict) or not entry.get('package_name') or \
+            not entry.get('package_version') or not entry.get('t'):
+        raise ValueError("missing package name, version, or time")
+    result = {}
+    for field in track_fields:
+        value = entry.get(field)
+        if value is not None:
+            # Longer values would fail the insert of the whole batch.
+            value = str(value)[0:getattr(Track, field).max_length]
+        result[field] = value
+    result['dp'] = result['dp'] or ""
+    result['ua'] = result['ua'] or ""
+    result['uip'] = result['uip'] or ""
+    t = entry['t'].rstrip("Z")
+    for time_format in time_formats:
+        try:
+            result['t'] = datetime.datetime.strptime(
+                t, time_format).replace(
+                    tzinfo=datetime.timezone.utc).astimezone().replace(tzinfo=None)
+            break
+        except ValueError:
+            pass
+    else:
+        raise ValueError("invalid time: {}".format(entry['t']))
+    return result
+
+
+class AccessLog(object):
+    """
+    An access log file, of JSON lines, that's appended to and eventually
+    rotated, and possibly gzip compressed. The file is identified by its first
+    line, which stays the same when it gets renamed or compressed. Offsets are
+    in the uncompressed content.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def open(self):
+        if self.path.endswith(".gz"):
+            return gzip.open(self.path, "rb")
+        return open(self.path, "rb")
+
+    def fingerprint(self):
+        """
+        The hash of the first line, or `None` when there isn't a complete one
+        yet.
+        """
+        with self.open() as f:
+            line = f.readline()
+        if not line.endswith(b"\n"):
+            return None
+        return hashlib.sha1(line).hexdigest()
+
+    def lines(self, offset=0):
+        """
+        Generate the `(end offset, line)` of the complete lines after the
+        offset. A partial last line, that's still being written, is left for
+        later.
+        """
+        with self.open() as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    return
+                offset += len(line)
+                if line.strip():
+                    yield offset, line
@@ -0,0 +1,147 @@
+# Copyright 2022 René Ferdinand Rivera Morell
+# Distributed under the Boost Software License, Version 1.0.
+# (See accompanying file LICENSE.txt or http://www.boost.org/LICENSE_1_0.txt)
+
+import contextlib
+import json
+import os
+import time
+
+
+def timed_call(function, *args):
+    """
+    Call the function with the arguments, returning the result and the seconds
+    the call took. For timing calls that run in other processes.
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+class Metrics(object):
+    """
+    Collects the wall and CPU time, and database queries, of processing phases.
+    Plus counters, and latencies of individual operations. Which can be written
+    out as JSON or as a Prometheus text file.
+    """
+
+    def __init__(self, prefix, db=None):
+        self.prefix = prefix
+        self.db = db
+        self.phases = {}
+        self.counters = {}
+        self.latencies = {}
+
+    def _phase(self, name):
+        return self.phases.setdefault(name, {
+            'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+            'queries': 0, 'query_seconds': 0.0})
+
+    def _add_phase(self, name, wall, cpu, queries, query_seconds):
+        phase = self._phase(name)
+        phase['wall_seconds'] += wall
+        phase['cpu_seconds'] += cpu
+        phase['queries'] += queries
+        phase['query_seconds'] += query_seconds
+
+    def _db_stats(self):
+        if self.db:
+            return self.db.query_count, self.db.query_seconds
+        return 0, 0.0
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Context that adds the time, and queries, within it to the phase.
+        """
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        queries, query_seconds = self._db_stats()
+        try:
+            yield
+        finally:
+            queries_end, query_seconds_end = self._db_stats()
+            self._add_phase(
+                name,
+                time.perf_counter() - wall, time.process_time() - cpu,
+                queries_end - queries, query_seconds_end - query_seconds)
+
+    def timed(self, name, iterable):
+        """
+        Iterate over the iterable, adding the time spent producing the items
+        to the phase. For timing generator stages.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        """
+        Record the latency of one operation.
+        """
+        latency = self.latencies.setdefault(name, {
+            'count': 0, 'sum_seconds': 0.0, 'max_seconds': 0.0})
+        latency['count'] += 1
+        latency['sum_seconds'] += seconds
+        latency['max_seconds'] = max(latency['max_seconds'], seconds)
+
+    def to_dict(self):
+        result = {
+            'phases': self.phases,
+            'counters': self.counters,
+            'latencies': self.latencies,
+        }
+        if self.db:
+            result['queries'], result['query_seconds'] = self._db_stats()
+        return result
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def write_prometheus(self, path):
+        """
+        Write the metrics in the Prometheus text format. The file is replaced
+        atomically, as expected by the node exporter text file collector.
+        """
+        p = self.prefix
+        lines = []
+
+        def metric(name, kind, help, values):
+            lines.append("# HELP {}_{} {}".format(p, name, help))
+            lines.append("# TYPE {}_{} {}".format(p, name, kind))
+            for labels, value in values:
+                lines.append("{}_{}{} {}".format(p, name, labels, value))
+
+        phases = sorted(self.phases.items())
+        for field, help in (
+                ('wall_seconds', "Wall time spent in the phase."),
+                ('cpu_seconds', "CPU time spent in the phase."),
+                ('queries', "Database queries issued in the phase."),
+                ('query_seconds', "Time spent in database queries in the phase.")):
+            metric("phase_" + field, "gauge", help, [
+                ('{{phase="{}"}}'.format(name), phase[field])
+                for name, phase in phases])
+        for name, value in sorted(self.counters.items()):
+            metric(name, "gauge", "Count of " + name.replace("_", " ") + ".",
+                   [("", value)])
+        for name, latency in sorted(self.latencies.items()):
+            metric(name + "_seconds", "summary",
+                   "Latency of " + name.replace("_", " ") + ".", [
+                       ("_count", latency['count']),
+                       ("_sum", latency['sum_seconds'])])
+            metric(name + "_max_seconds", "gauge",
+                   "Maximum latency of " + name.replace("_", " ") + ".",
+                   [("", latency['max_seconds'])])
+        metric("last_run_timestamp_seconds", "gauge",
+               "Time the metrics were written.", [("", time.time())])
+        with open(path + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
@@ -0,0 +1,118 @@
+# Copyright 2022 René Ferdinand Rivera Morell
+# Distributed under the Boost Software License, Version 1.0.
+# (See accompanying file LICENSE.txt or http://www.boost.org/LICENSE_1_0.txt)
+
+from .db import Meta
+
+
+class Migration(object):
+    """
+    Runs the steps of a schema migration to a version. Each completed step,
+    and the progress within chunked steps, is recorded in the "migration"
+    Meta entry. Such that running an interrupted migration again resumes
+    where it stopped.
+    """
+
+    def __init__(self, db, version):
+        self.db = db
+        self.version = version
+        self.step = None
+        with self.db.atomic():
+            meta = Meta.get_or_none(Meta.id == "migration")
+            self.state = meta.value if meta else None
+        if not self.state or self.state.get('version') != version:
+            self.state = {'version': version, 'steps': [], 'progress': {}}
+
+    def save(self):
+        with self.db.atomic():
+            Meta.replace(id="migration", value=self.state).execute()
+
+    def run(self, steps):
+        """
+        Run the `(name, function)` steps, in order, that didn't complete
+        already.
+        """
+        for name, function in steps:
+            if name in self.state['steps']:
+                print("[INFO] Skipping completed step:", name)
+                continue
+            print("[INFO] Running step:", name)
+            self.step = name
+            function()
+            self.state['steps'].append(name)
+            self.state['progress'].pop(name, None)
+            self.save()
+        self.step = None
+
+    def finish(self):
+        with self.db.atomic():
+            Meta.delete().where(Meta.id == "migration").execute()
+
+    def mapping_table(self, name):
+        return "barbarian_migrate_" + name
+
+    def create_mapping(self, name, mapping, batch_size=1000):
+        """
+        Load the mapping, of old to new values, into a table for joined
+        updates. It's a regular table, instead of a temporary one, such that
+        it's still there to resume an interrupted migration with. Which
+        matters when the new values are generated.
+        """
+        table = self.mapping_table(name)
+        self.db.execute_sql("DROP TABLE IF EXISTS `{}`".format(table))
+        self.db.execute_sql(
+            "CREATE TABLE `{}` (`old` VARCHAR(100) NOT NULL PRIMARY KEY, "
+            "`new` VARCHAR(100) NOT NULL)".format(table))
+        items = [(str(old), str(new)) for old, new in mapping.items()]
+        values = "({0}, {0})".format(self.db.param)
+        for i in range(0, len(items), batch_size):
+            batch = items[i:i+batch_size]
+            with self.db.atomic():
+                self.db.execute_sql(
+                    "INSERT INTO `{}` (`old`, `new`) VALUES {}".format(
+                        table, ", ".join([values] * len(batch))),
+                    [value for item in batch for value in item])
+
+    def drop_mapping(self, name):
+        self.db.execute_sql(
+            "DROP TABLE IF EXISTS `{}`".format(self.mapping_table(name)))
+
+    def remap(self, table, column, name, key=None, chunk_size=10000):
+        """
+        Replace the old values of the column with the new values of the
+        mapping, with joined UPDATEs. Given an integer key column, the rows
+        are updated in chunks of key ranges, each in its own transaction and
+        recording the progress. Updating again is harmless, as new values
+        don't match old ones.
+        """
+        mapping = self.mapping_table(name)
+        if self.db.is_mysql:
+            update = "UPDATE `{t}` JOIN `{m}` ON `{t}`.`{c}` = `{m}`.`old` " \
+                "SET `{t}`.`{c}` = `{m}`.`new` WHERE 1 = 1"
+        else:
+            update = "UPDATE `{t}` SET `{c}` = " \
+                "(SELECT `new` FROM `{m}` WHERE `{m}`.`old` = `{t}`.`{c}`) " \
+                "WHERE `{c}` IN (SELECT `old` FROM `{m}`)"
+        update = update.format(t=table, c=column, m=mapping)
+        if not key:
+            with self.db.atomic():
+                self.db.execute_sql(update)
+            return
+        update += " AND `{t}`.`{k}` >= {p} AND `{t}`.`{k}` < {p}".format(
+            t=table, k=key, p=self.db.param)
+        first, last = self.db.execute_sql(
+            "SELECT MIN(`{k}`), MAX(`{k}`) FROM `{t}`".format(
+                t=table, k=key)).fetchone()
+        if first is None:
+            return
+        start = self.state['progress'].get(self.step, first)
+        while start <= last:
+            end = start + chunk_size
+            with self.db.atomic():
+                self.db.execute_sql(update, (start, end))
+                self.state['progress'][self.step] = end
+                self.save()
+            print("[INFO] Updated {}.{}: {:.0f}%".format(
+                table, column,
+                100.0 * (min(end, last + 1) - first) / (last + 1 - first)))
+            start = end
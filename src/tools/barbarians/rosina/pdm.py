@@ -0,0 +1,80 @@
+# Copyright 2021-2022 René Ferdinand Rivera Morell
+# Distributed under the Boost Software License, Version 1.0.
+# (See accompanying file LICENSE.txt or http://www.boost.org/LICENSE_1_0.txt)
+
+# The Conan client is only imported when used, as it takes longer to import
+# than all the rest of rosina.
+
+conan_remote = "barbarian-github"
+conan_remote_url = "https://barbarian.bfgroup.xyz/github"
+conan_attributes = [
+    'barbarian', 'name', 'version', 'url', 'homepage', 'license', 'author',
+    'description', 'topics', 'settings', 'options', 'default_options']
+
+_conan_api = None
+
+
+def conan_api():
+    """
+    The Conan API instance, for this process, configured to use the Barbarian
+    remote. Shared by all the Conan PDM operations.
+    """
+    global _conan_api
+    if not _conan_api:
+        import conans.client.conan_api
+        _conan_api = conans.client.conan_api.Conan.factory()[0]
+        _conan_api.config_set("general.revisions_enabled", "True")
+        _conan_api.remote_add(conan_remote, conan_remote_url, force=True)
+    return _conan_api
+
+
+def conan_package_info(name, version, identity):
+    """
+    Fetch the information for a package in a Conan remote repository.
+    """
+    import conans.errors
+    api = conan_api()
+    package_ref = "{}/{}@{}".format(name, version, identity.split("#")[0])
+    try:
+        package_info = api.inspect(
+            package_ref, conan_attributes, conan_remote)
+    except conans.errors.NotFoundException:
+        print("[ERROR] Failed to inspect package",
+              package_ref, "ignoring.")
+        return None
+    # Extract description if it's from an export file.
+    if 'barbarian' in package_info and 'description' in package_info['barbarian'] and 'file' in package_info['barbarian']['description']:
+        description_file = package_info['barbarian']['description']['file']
+        try:
+            description_text, _ = api.get_path(
+                package_ref,
+                path=description_file,
+                remote_name=conan_remote)
+            if description_text:
+                package_info['barbarian']['description']['text'] = description_text
+                print("[INFO] Obtained description text for package",
+                      package_ref, "from export file", description_file)
+        finally:
+            # Ignore errors from fetching description data?
+            pass
+    return package_info
+
+
+def stub_package_info(name, version, identity):
+    """
+    Synthetic information for a package, in the same form as the Conan info.
+    For testing and benchmarking without a PDM.
+    """
+    return {
+        'name': name,
+        'version': version,
+        'url': None,
+        'homepage': None,
+        'license': 'BSL-1.0',
+        'author': None,
+        'description': "The {} package.".format(name),
+        'topics': [name, 'stub'],
+        'settings': None,
+        'options': {},
+        'default_options': {},
+    }
@@ -0,0 +1,117 @@
+# Copyright 2022 René Ferdinand Rivera Morell
+# Distributed under the Boost Software License, Version 1.0.
+# (See accompanying file LICENSE.txt or http://www.boost.org/LICENSE_1_0.txt)
+
+from argparse import ArgumentParser
+import json
+import subprocess
+import sys
+
+
+class StartupBench(object):
+    """
+    Benchmark of the Rosina CLI startup, i.e. the time to import it as
+    reported by "python -X importtime". It fails when the import takes longer
+    than the budget, or when it imports modules that should only be imported
+    by the commands that need them. Such that regressions in startup time get
+    noticed.
+    """
+
+    # The modules that take a long time to import, and that only some of the
+    # commands use.
+    lazy_modules = [
+        "conans", "semver", "ua_parser", "playhouse.migrate",
+        "multiprocessing"]
+
+    def __init__(self, argv=None):
+        ap = ArgumentParser(
+            "barbarian_rosina_startup",
+            description="Benchmark the import time of the Rosina CLI against a budget.")
+        ap.add_argument(
+            "--module",
+            help="Module to import.",
+            default="barbarians.rosina.cli")
+        ap.add_argument(
+            "--budget",
+            help="Maximum import time in milliseconds.",
+            type=float,
+            default=150.0)
+        ap.add_argument(
+            "--runs",
+            help="Number of times to import, the fastest one counts.",
+            type=int,
+            default=5)
+        ap.add_argument(
+            "--top",
+            help="Number of the slowest imported modules to show.",
+            type=int,
+            default=10)
+        ap.add_argument(
+            "--json",
+            help="File to write the results to as JSON.")
+        self.args = ap.parse_args(argv)
+        if not self.run():
+            sys.exit(1)
+
+    def import_times(self):
+        """
+        The self and cumulative import time, in microseconds, of each of the
+        modules imported by importing the module in a new interpreter.
+        """
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c",
+             "import " + self.args.module],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            universal_newlines=True)
+        if result.returncode != 0:
+            raise RuntimeError("Failed to import {}:\n{}".format(
+                self.args.module, result.stderr))
+        times = {}
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:"):
+                continue
+            own, cumulative, name = line[12:].split("|")
+            if own.strip().isdigit():
+                times[name.strip()] = (int(own), int(cumulative))
+        return times
+
+    def run(self):
+        fastest = None
+        for i in range(self.args.runs):
+            times = self.import_times()
+            if not fastest or times[self.args.module][1] < fastest[self.args.module][1]:
+                fastest = times
+        total = fastest[self.args.module][1] / 1000.0
+        lazy = sorted(name for name in fastest if any(
+            name == m or name.startswith(m + ".") for m in self.lazy_modules))
+        slowest = sorted(fastest.items(), key=lambda item: -item[1][0])
+        print("Import of {}: {:.1f} ms, budget {:.1f} ms.".format(
+            self.args.module, total, self.args.budget))
+        for name, (own, cumulative) in slowest[0:self.args.top]:
+            print("  {}: {:.1f} ms".format(name, own / 1000.0))
+        if self.args.json:
+            with open(self.args.json, "w") as f:
+                json.dump({
+                    'module': self.args.module,
+                    'milliseconds': total,
+                    'budget': self.args.budget,
+                    'lazy_imported': lazy,
+                    'modules': {name: own / 1000.0 for name, (own, cumulative) in fastest.items()},
+                }, f, indent=2)
+        ok = True
+        if total > self.args.budget:
+            print("[ERROR] Import time is over the budget.")
+            ok = False
+        if lazy:
+            print("[ERROR] Imported modules that should be imported on use:",
+                  *lazy)
+            ok = False
+        return ok
+
+
+def main():
+    StartupBench()
+
+
+if __name__ == '__main__':
+    main()
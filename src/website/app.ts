@@ -8,6 +8,7 @@ http://www.boost.org/LICENSE_1_0.txt)
 import express from "express";
 import { Request, Response } from "express";
 import { AddressInfo } from "net"
+import { promises as fs } from "fs";
 import fetch from "node-fetch";
 import ExpressGA from "express-universal-analytics";
 import mysql from "mysql2/promise";
@@ -715,7 +716,46 @@ async function ensure_available(req: Request, res: Response, next: any) {
 	}
 }
 
+/*
+	When set, downloads are appended to this access log file, for
+	`barbarian_rosina ingest` to add to the track log. Instead of inserting
+	each one into the database. The times are in UTC, which the ingest
+	converts to the local time of the track log, like the database default.
+*/
+const track_log_path = process.env.BARBARIAN_TRACK_LOG;
+
+/*
+	Rosina fetches recipe exports to refresh the project info, which are not
+	downloads.
+*/
+const untracked_user_agent = "barbarian-rosina";
+
 async function track_download(req: Request, res: Response) {
+	if ((req.headers['user-agent'] || "").startsWith(untracked_user_agent)) {
+		return;
+	}
+	var track = {
+		package_name: req.params.package_name,
+		package_version: req.params.package_version,
+		package_username: req.params.package_username,
+		package_channel: req.params.package_channel,
+		revision: req.params.revision,
+		dp: req.originalUrl,
+		ua: <string>req.headers['user-agent'],
+		uip: req.connection.remoteAddress
+			|| req.socket.remoteAddress
+			|| (<string>req.headers['x-forwarded-for']).split(',').pop()
+	};
+	if (track_log_path) {
+		try {
+			await fs.appendFile(track_log_path,
+				JSON.stringify({ ...track, t: new Date().toISOString() }) + "\n");
+		} catch (e) {
+			console.error("[ERROR] track_download failed: " + e);
+			return send_error(res, 500, "[ERROR] track_download failed: " + e);
+		}
+		return;
+	}
 	try {
 		var connection = undefined;
 		try {
@@ -728,18 +768,7 @@ async function track_download(req: Request, res: Response) {
 				+ ' package_channel = :package_channel,'
 				+ ' revision = :revision,'
 				+ ' dp = :dp, ua = :ua, uip = :uip',
-				{
-					package_name: req.params.package_name,
-					package_version: req.params.package_version,
-					package_username: req.params.package_username,
-					package_channel: req.params.package_channel,
-					revision: req.params.revision,
-					dp: req.originalUrl,
-					ua: <string>req.headers['user-agent'],
-					uip: req.connection.remoteAddress
-						|| req.socket.remoteAddress
-						|| (<string>req.headers['x-forwarded-for']).split(',').pop()
-				});
+				track);
 		} finally {
 			db_release(connection);
 		}